@@ -3,22 +3,39 @@ import os
 
 load_dotenv()
 
-from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify
+from flask import Flask, render_template, request, flash, redirect, session, g, url_for, jsonify, Response, stream_with_context
 from flask_debugtoolbar import DebugToolbarExtension
 from functools import wraps
-from sqlalchemy.exc import IntegrityError
+import json
+import time
+import hashlib
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from googleplaces import GooglePlaces, types, lang
-import random
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+from collections import Counter
 from flask_cors import CORS
 
 # the '.' was added to support the website launch on render. For testing or if running the app locally, please comment out the next two lines and uncomment the following two. 
-from .models import connect_db, db, User, Itinerary, Activity
+from .models import connect_db, db, User, Itinerary, Activity, GeocodeCache, IdempotencyKey, Place, Job
 from .forms import UserAddForm, LoginForm
-# from models import connect_db, db, User, Itinerary, Activity
+from .cache import TTLCache, SeenPlaces, SingleFlight, nearby_search_key, quantize_radius, within_radius
+from .google_maps import GoogleMapsClient, GoogleMapsUnavailable, Deadline, DeadlineExceeded, GOOGLE_MAPS_BASE_URL, check_status
+from .jobs import ThreadJobQueue
+from .sampling import SELECTION_STRATEGIES
+# from models import connect_db, db, User, Itinerary, Activity, GeocodeCache, IdempotencyKey, Place, Job
 # from forms import UserAddForm, LoginForm
+# from cache import TTLCache, SeenPlaces, SingleFlight, nearby_search_key, quantize_radius, within_radius
+# from google_maps import GoogleMapsClient, GoogleMapsUnavailable, Deadline, DeadlineExceeded, GOOGLE_MAPS_BASE_URL, check_status
+# from jobs import ThreadJobQueue
+# from sampling import SELECTION_STRATEGIES
 
 CURR_USER_KEY = "curr_user"
+# cached in place of the coordinates of an address that could not be geocoded
+GEOCODE_ZERO_RESULTS = "ZERO_RESULTS"
+# only the fields that are saved on an Activity are requested from Place Details
+PLACE_DETAILS_FIELDS = "url,editorial_summary"
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 google_places = GooglePlaces(GOOGLE_MAPS_API_KEY)
 
@@ -36,10 +53,173 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY')
+# maximum number of categories searched in parallel for a single request
+app.config['MAX_ACTIVITY_WORKERS'] = int(os.environ.get('MAX_ACTIVITY_WORKERS', 5))
+# how the activities are picked from the places found for a category: 'weighted' favours well rated, popular places
+# and 'uniform' picks any of them. ACTIVITY_SEED makes the picks reproducible, e.g. for benchmarks.
+app.config['ACTIVITY_SELECTION'] = os.environ.get('ACTIVITY_SELECTION', 'weighted')
+app.config['ACTIVITY_SEED'] = os.environ.get('ACTIVITY_SEED')
+# seconds that generating activities may take. Categories that are not done by then are skipped.
+app.config['ACTIVITY_DEADLINE'] = float(os.environ.get('ACTIVITY_DEADLINE', 10))
+# seconds that refreshing a stale cache entry in the background may take
+app.config['REVALIDATE_DEADLINE'] = float(os.environ.get('REVALIDATE_DEADLINE', 10))
+# the places of each user's activities are kept in memory so that new activities can avoid them. SEEN_PLACES_TTL
+# bounds how long activities added or deleted by another process go unnoticed.
+app.config['SEEN_PLACES_TTL'] = int(os.environ.get('SEEN_PLACES_TTL', 10 * 60))
+app.config['SEEN_PLACES_SIZE'] = int(os.environ.get('SEEN_PLACES_SIZE', 10000))
+# geocoded addresses are cached in memory and in the geocode_cache table (ttl in seconds)
+app.config['GEOCODE_CACHE_TTL'] = int(os.environ.get('GEOCODE_CACHE_TTL', 30 * 24 * 60 * 60))
+app.config['GEOCODE_CACHE_SIZE'] = int(os.environ.get('GEOCODE_CACHE_SIZE', 1024))
+app.config['GEOCODE_CACHE_MAX_ROWS'] = int(os.environ.get('GEOCODE_CACHE_MAX_ROWS', 10000))
+# nearby search results are cached by geohash cell (precision = number of geohash characters), radius bucket and keyword
+app.config['NEARBY_CACHE_TTL'] = int(os.environ.get('NEARBY_CACHE_TTL', 24 * 60 * 60))
+app.config['NEARBY_CACHE_SIZE'] = int(os.environ.get('NEARBY_CACHE_SIZE', 2048))
+app.config['NEARBY_GEOHASH_PRECISION'] = int(os.environ.get('NEARBY_GEOHASH_PRECISION', 6))
+# place details are cached by place_id
+app.config['DETAILS_CACHE_TTL'] = int(os.environ.get('DETAILS_CACHE_TTL', 7 * 24 * 60 * 60))
+app.config['DETAILS_CACHE_SIZE'] = int(os.environ.get('DETAILS_CACHE_SIZE', 4096))
+# place details are not requested while generating activities. They are requested when a page shows the activities, waiting at
+# most DETAILS_DEADLINE seconds. Set PREFETCH_PLACE_DETAILS to 1 to prefetch them in the background once the activities are saved,
+# which costs a details request for every generated activity, including the ones that are deleted or rerolled later.
+app.config['PREFETCH_PLACE_DETAILS'] = os.environ.get('PREFETCH_PLACE_DETAILS', '0') == '1'
+app.config['DETAILS_DEADLINE'] = float(os.environ.get('DETAILS_DEADLINE', 3))
+# places from nearby searches are kept in the places table. A category is picked from it without searching Google when at
+# least PLACE_INDEX_MIN_CANDIDATES places near the itinerary were found by that keyword in the last PLACE_INDEX_TTL seconds.
+app.config['PLACE_INDEX_TTL'] = int(os.environ.get('PLACE_INDEX_TTL', 7 * 24 * 60 * 60))
+app.config['PLACE_INDEX_MIN_CANDIDATES'] = int(os.environ.get('PLACE_INDEX_MIN_CANDIDATES', 10))
+# addresses and searches that Google found nothing for are remembered for this many seconds
+app.config['NEGATIVE_CACHE_TTL'] = int(os.environ.get('NEGATIVE_CACHE_TTL', 10 * 60))
+# retries and keep-alive connections of the shared Google Maps client
+app.config['GOOGLE_MAPS_RETRIES'] = int(os.environ.get('GOOGLE_MAPS_RETRIES', 2))
+app.config['GOOGLE_MAPS_POOL_SIZE'] = int(os.environ.get('GOOGLE_MAPS_POOL_SIZE', 20))
+# set to the url of a stand-in server (see benchmarks/maps_stub.py) to avoid using real API quota
+app.config['GOOGLE_MAPS_BASE_URL'] = os.environ.get('GOOGLE_MAPS_BASE_URL', GOOGLE_MAPS_BASE_URL)
+# overrides of the default (connect, read) timeouts per endpoint, e.g. {'nearbysearch': (3.05, 15)}
+app.config['GOOGLE_MAPS_TIMEOUTS'] = {}
+# overrides of the default (requests per second, burst) budget per endpoint, e.g. {'details': (20, 40)}
+app.config['GOOGLE_MAPS_RATE_LIMITS'] = {}
+# the most concurrent requests per endpoint, which is lowered automatically while Google throttles us
+app.config['GOOGLE_MAPS_MAX_CONCURRENCY'] = int(os.environ.get('GOOGLE_MAPS_MAX_CONCURRENCY', 10))
+# how long (in seconds) a request waits for the rate limiter before failing
+app.config['GOOGLE_MAPS_MAX_WAIT'] = float(os.environ.get('GOOGLE_MAPS_MAX_WAIT', 5))
+# slow requests to these endpoints are sent a second time once they take longer than the percentile of their recent
+# latencies, with at most max_ratio extra requests. Set to {} to turn hedging off.
+app.config['GOOGLE_MAPS_HEDGING'] = {'nearbysearch': {'percentile': 95, 'max_ratio': 0.05}}
+# the circuit of an endpoint opens when CIRCUIT_FAILURE_RATE of its last CIRCUIT_WINDOW requests failed or took longer
+# than CIRCUIT_SLOW_MS, and half-opens after CIRCUIT_RESET_TIMEOUT seconds. Cached results are served while it is open.
+app.config['CIRCUIT_WINDOW'] = int(os.environ.get('CIRCUIT_WINDOW', 20))
+app.config['CIRCUIT_FAILURE_RATE'] = float(os.environ.get('CIRCUIT_FAILURE_RATE', 0.5))
+app.config['CIRCUIT_SLOW_MS'] = float(os.environ.get('CIRCUIT_SLOW_MS', 3000))
+app.config['CIRCUIT_RESET_TIMEOUT'] = float(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+# threads that run activity generation jobs requested with the "Prefer: respond-async" header, and how long (in seconds) jobs are kept in the jobs table
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', 4))
+app.config['JOB_TTL'] = int(os.environ.get('JOB_TTL', 60 * 60))
+# how often (in seconds) the event stream of a job checks its progress, and how long it follows the job before giving up
+app.config['JOB_STREAM_INTERVAL'] = float(os.environ.get('JOB_STREAM_INTERVAL', 0.25))
+app.config['JOB_STREAM_TIMEOUT'] = float(os.environ.get('JOB_STREAM_TIMEOUT', app.config['ACTIVITY_DEADLINE'] + 30))
+# how long (in seconds) the response to a request with an Idempotency-Key is replayed to retries of it
+app.config['IDEMPOTENCY_TTL'] = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 60 * 60))
+# seconds after which a request with an Idempotency-Key that has not responded is assumed to have died, so that a retry can take it over
+app.config['IDEMPOTENCY_LEASE'] = float(os.environ.get('IDEMPOTENCY_LEASE', app.config['ACTIVITY_DEADLINE'] + 30))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
+maps_client = GoogleMapsClient(
+    GOOGLE_MAPS_API_KEY,
+    timeouts=app.config['GOOGLE_MAPS_TIMEOUTS'],
+    retries=app.config['GOOGLE_MAPS_RETRIES'],
+    pool_size=app.config['GOOGLE_MAPS_POOL_SIZE'],
+    rate_limits=app.config['GOOGLE_MAPS_RATE_LIMITS'],
+    max_concurrency=app.config['GOOGLE_MAPS_MAX_CONCURRENCY'],
+    max_wait=app.config['GOOGLE_MAPS_MAX_WAIT'],
+    circuit_breaker={
+        'window': app.config['CIRCUIT_WINDOW'],
+        'failure_rate': app.config['CIRCUIT_FAILURE_RATE'],
+        'slow_ms': app.config['CIRCUIT_SLOW_MS'],
+        'reset_timeout': app.config['CIRCUIT_RESET_TIMEOUT']
+    },
+    hedging=app.config['GOOGLE_MAPS_HEDGING'],
+    base_url=app.config['GOOGLE_MAPS_BASE_URL']
+)
+geocode_cache = TTLCache(maxsize=app.config['GEOCODE_CACHE_SIZE'], ttl=app.config['GEOCODE_CACHE_TTL'])
+# hits and misses of the geocode_cache table, which is only checked after a miss in memory
+geocode_db_stats = {'hits': 0, 'misses': 0}
+nearby_cache = TTLCache(maxsize=app.config['NEARBY_CACHE_SIZE'], ttl=app.config['NEARBY_CACHE_TTL'])
+details_cache = TTLCache(maxsize=app.config['DETAILS_CACHE_SIZE'], ttl=app.config['DETAILS_CACHE_TTL'])
+selection = SELECTION_STRATEGIES[app.config['ACTIVITY_SELECTION']](seed=app.config['ACTIVITY_SEED'])
+# categories that were picked from the places table (hits) or had to be searched (misses)
+place_index_stats = {'hits': 0, 'misses': 0}
+seen_places = SeenPlaces(
+    lambda user_id: [place_id for (place_id,) in db.session.query(Activity.place_id).filter(Activity.user_id == user_id, Activity.place_id.isnot(None))],
+    maxsize=app.config['SEEN_PLACES_SIZE'],
+    ttl=app.config['SEEN_PLACES_TTL']
+)
+# identical Google requests made at the same time by different threads share one outbound request
+google_requests = SingleFlight()
+# refreshes stale cache entries in the background once an open circuit half-opens
+revalidator = ThreadPoolExecutor(max_workers=2, thread_name_prefix='revalidate')
+details_prefetcher = ThreadPoolExecutor(max_workers=2, thread_name_prefix='details-prefetch')
+job_queue = ThreadJobQueue(app, max_workers=app.config['JOB_WORKERS'], ttl=app.config['JOB_TTL'])
+
+# seen_places follows the activities as they are inserted, rerolled and deleted, so it never has to be reloaded.
+# The changes are flushed before they are committed, so they wait in the session and are only applied once it commits.
+def queue_seen_place(activity, change, place_id):
+    """Remembers a change to the user's seen places together with the transaction, or savepoint, that made it"""
+    session = inspect(activity).session
+    transaction = session.get_nested_transaction() or session.get_transaction()
+    session.info.setdefault('seen_place_changes', []).append((transaction, change, activity.user_id, place_id))
+
+@event.listens_for(Activity, 'after_insert')
+def add_seen_place(mapper, connection, activity):
+    """Adds the place of a new activity to its user's seen places"""
+    if activity.place_id:
+        queue_seen_place(activity, seen_places.add, activity.place_id)
+
+@event.listens_for(Activity, 'after_update')
+def update_seen_place(mapper, connection, activity):
+    """Replaces the place of a rerolled activity in its user's seen places"""
+    history = inspect(activity).attrs.place_id.history
+    for place_id in history.deleted or ():
+        if place_id:
+            queue_seen_place(activity, seen_places.discard, place_id)
+    for place_id in history.added or ():
+        if place_id:
+            queue_seen_place(activity, seen_places.add, place_id)
+
+@event.listens_for(Activity, 'after_delete')
+def discard_seen_place(mapper, connection, activity):
+    """Removes the place of a deleted activity from its user's seen places"""
+    if activity.place_id:
+        queue_seen_place(activity, seen_places.discard, activity.place_id)
+
+@event.listens_for(OrmSession, 'after_commit')
+def apply_seen_places(session):
+    """Applies the seen place changes once the outermost transaction commits. Released savepoints keep theirs until then."""
+    if not session.in_nested_transaction():
+        for transaction, change, user_id, place_id in session.info.pop('seen_place_changes', []):
+            change(user_id, place_id)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def drop_seen_places(session):
+    """Drops every seen place change when the outermost transaction rolls back"""
+    if not session.in_nested_transaction():
+        session.info.pop('seen_place_changes', None)
+
+@event.listens_for(OrmSession, 'after_soft_rollback')
+def drop_savepoint_seen_places(session, previous_transaction):
+    """Drops the seen place changes made in a rolled back savepoint, including the savepoints it had released"""
+    def rolled_back(transaction):
+        while transaction is not None:
+            if transaction is previous_transaction:
+                return True
+            transaction = transaction.parent
+        return False
+
+    changes = session.info.get('seen_place_changes')
+    if changes:
+        session.info['seen_place_changes'] = [change for change in changes if not rolled_back(change[0])]
+
 @app.before_request
 def add_user_to_g():
     """Add the curent user to Flask global if logging in."""
@@ -68,63 +248,366 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
         
-def get_long_lat(address):
-    """Returns the longitude and latitude of the given address"""
-    response = requests.get("https://maps.googleapis.com/maps/api/geocode/json", params={'address':address, 'key': GOOGLE_MAPS_API_KEY})
-    data = response.json()
-    
-    if response.status_code == 200 and data['status'] == 'OK':
-        # Get the latitude and longitude from the response
-        location = data['results'][0]['geometry']['location']
-        latitude = location['lat']
-        longitude = location['lng']
-        return latitude, longitude
-    else:
-        raise Exception(f"Error getting geocode: {data['status']}")
+def normalize_address(address):
+    """Normalizes the case, commas and whitespace of an address so that equivalent addresses share a cache entry"""
+    return " ".join(address.lower().replace(",", " ").split())
+
+def get_long_lat(address, deadline=None):
+    """Returns the latitude and longitude of the given address, using the geocode cache when possible"""
+    key = normalize_address(address)
+    location = geocode_cache.get(key)
+    if location == GEOCODE_ZERO_RESULTS:
+        raise Exception(f"Error getting geocode: {GEOCODE_ZERO_RESULTS}")
+    if location:
+        return location
+    
+    location = GeocodeCache.lookup(key, app.config['GEOCODE_CACHE_TTL'])
+    if location:
+        geocode_db_stats['hits'] += 1
+        geocode_cache.set(key, location)
+        return location
+    geocode_db_stats['misses'] += 1
+    
+    location = google_requests.do(('geocode', key), fetch_long_lat, address, deadline=deadline)
+    if location is None:
+        # remember for a short while that the address does not exist so that retries do not ask Google again
+        geocode_cache.set(key, GEOCODE_ZERO_RESULTS, ttl=app.config['NEGATIVE_CACHE_TTL'])
+        raise Exception(f"Error getting geocode: {GEOCODE_ZERO_RESULTS}")
+    geocode_cache.set(key, location)
+    GeocodeCache.store(key, *location, app.config['GEOCODE_CACHE_MAX_ROWS'])
+    return location
+
+def fetch_long_lat(address, deadline=None):
+    """Requests the latitude and longitude of the given address from the Geocoding API, or returns None if the address was not found"""
+    data = check_status('geocode', maps_client.get('geocode', {'address': address}, deadline=deadline))
+    
+    if data['status'] == GEOCODE_ZERO_RESULTS:
+        return None
+    # Get the latitude and longitude from the response
+    location = data['results'][0]['geometry']['location']
+    latitude = location['lat']
+    longitude = location['lng']
+    return latitude, longitude
         
-def process_activities(itinerary, categories):
-    """Processes the categories given by the user to return random activities"""
-    for category in categories:
-    # Make a request to Google Places API
-        location = get_long_lat(itinerary.location)
-        location_str = f"{location[0]},{location[1]}"
-        resp = requests.get('https://maps.googleapis.com/maps/api/place/nearbysearch/json', params={
-            'location': location_str,  
-            'radius': itinerary.radius,  
-            'keyword': category, 
-            'key': GOOGLE_MAPS_API_KEY
+def get_cached(cache, endpoint, key, fetch, *args, deadline=None):
+    """Returns the value cached under the key, or calls fetch(*args, deadline=deadline) to request it from Google.
+    While the circuit of the endpoint is not closed an expired value is returned instead, and it is
+    refreshed in the background, with its own REVALIDATE_DEADLINE, once the circuit half-opens."""
+    value = cache.get(key)
+    if value is not None:
+        return value
+    
+    state = maps_client.circuit_state(endpoint)
+    if state != 'closed':
+        value = cache.get_stale(key)
+        if value is not None:
+            if state == 'half_open':
+                revalidator.submit(google_requests.do, (endpoint, key), fetch, *args, deadline=Deadline(app.config['REVALIDATE_DEADLINE']))
+            return value
+    return google_requests.do((endpoint, key), fetch, *args, deadline=deadline)
+        
+def nearby_search(location, radius, keyword, deadline=None):
+    """Returns the places within radius meters of the (latitude, longitude) location matching the keyword, using the nearby search cache when possible.
+    The search covers the radius bucket around a location in the same geohash cell, so the places farther than the radius are left out."""
+    key = nearby_search_key(location, radius, keyword, app.config['NEARBY_GEOHASH_PRECISION'])
+    places = get_cached(nearby_cache, 'nearbysearch', key, fetch_nearby_search, key, location, radius, keyword, deadline=deadline)
+    return within_radius(places, location, radius)
+        
+def fetch_nearby_search(key, location, radius, keyword, deadline=None):
+    """Requests the places near the location matching the keyword from the Google Places API and caches them under the key"""
+    location_str = f"{location[0]},{location[1]}"
+    resp = maps_client.get('nearbysearch', {
+        'location': location_str,  
+        'radius': quantize_radius(radius),  
+        'keyword': keyword
+    }, deadline=deadline)
+    
+    # throttled, denied and invalid searches raise, so that only a ZERO_RESULTS search is reported as empty
+    data = check_status('nearbysearch', resp)
+    places = data.get('results', [])
+    if places:
+        nearby_cache.set(key, places)
+        harvest_places(keyword, places)
+    elif data.get('status') == 'ZERO_RESULTS':
+        # searches with no places are cached for a shorter time, since new places may open
+        nearby_cache.set(key, places, ttl=app.config['NEGATIVE_CACHE_TTL'])
+    return places
+        
+def harvest_places(keyword, places):
+    """Saves the places found by a search for the keyword in the places table. The search still succeeds if they cannot be saved."""
+    # searches run outside of the request's thread, so the places are saved with their own app context and database session
+    with app.app_context():
+        try:
+            Place.harvest(keyword, places)
+        except SQLAlchemyError:
+            db.session.rollback()
+        
+def get_place_details(place_id, deadline=None):
+    """Returns the details of the place, using the details cache when possible"""
+    return get_cached(details_cache, 'details', place_id, fetch_place_details, place_id, deadline=deadline)
+        
+def fetch_place_details(place_id, deadline=None):
+    """Requests the details of the place from the Google Places API and caches them. Returns {} for a place Google no longer
+    knows, e.g. an obsolete place_id, and raises if the request failed, so that only failed requests are tried again."""
+    details_resp = maps_client.get('details', {
+        'place_id': place_id,
+        'fields': PLACE_DETAILS_FIELDS
+    }, deadline=deadline)
+    
+    data = check_status('details', details_resp, statuses=('OK', 'NOT_FOUND', 'INVALID_REQUEST'))
+    if data['status'] != 'OK':
+        # remember for a short while that the place has no details, like an address that was not found
+        details_cache.set(place_id, {}, ttl=app.config['NEGATIVE_CACHE_TTL'])
+        return {}
+    details = data.get('result', {})
+    details_cache.set(place_id, details)
+    return details
+        
+def load_place_details(activities, deadline=None):
+    """Fills in the url and summary of the places of the activities whose details were not loaded yet, requesting the details
+    of each place once and concurrently. Places whose details request failed are left to be loaded next time."""
+    pending = {activity.place_id: activity.place for activity in activities if not activity.place.details_loaded}
+    place_ids = set(pending)
+    if not place_ids:
+        return
+    
+    details = {}
+    with ThreadPoolExecutor(max_workers=min(len(place_ids), app.config['MAX_ACTIVITY_WORKERS'])) as executor:
+        futures = {executor.submit(get_place_details, place_id, deadline): place_id for place_id in place_ids}
+        for future in as_completed(futures):
+            try:
+                details[futures[future]] = future.result()
+            except Exception:
+                # the activities of the place are shown without its details this time
+                pass
+    
+    # a place without details is marked as loaded too, so that it is not requested on every view
+    for place_id, place_details in details.items():
+        pending[place_id].set_details(place_details)
+    db.session.commit()
+
+def prefetch_place_details(activity_ids):
+    """Loads the place details of the new activities in the background so that they are usually ready before they are viewed"""
+    if activity_ids and app.config['PREFETCH_PLACE_DETAILS']:
+        details_prefetcher.submit(run_details_prefetch, activity_ids)
+
+def run_details_prefetch(activity_ids):
+    """Loads the place details of the activities with the ids"""
+    # the prefetch runs outside of the request, so it needs its own app context and database session
+    with app.app_context():
+        load_place_details(Activity.query.filter(Activity.id.in_(activity_ids)).all())
+        
+def find_activities(location, radius, category, count, deadline=None, places=None, seen=frozenset()):
+    """Returns the fields of up to count different random places for the category near the (latitude, longitude) location.
+    The places are picked from the given search results, or Google Places is searched for the category once if there are none.
+    Places whose place_id is in seen are only picked when there are not enough others."""
+    if places is None:
+        places = nearby_search(location, radius, category, deadline=deadline)
+    
+    # Randomly select distinct places from the results. Their details are loaded later, once they are viewed.
+    # The categories are searched concurrently, so a seeded selection draws each search's picks from its own generator.
+    rng = selection.rng_for(nearby_search_key(location, radius, category, app.config['NEARBY_GEOHASH_PRECISION']))
+    activities = []
+    for selected_place in selection.select_fresh(places, count, seen, rng=rng):
+        activities.append({
+            'title': selected_place['name'],
+            'category': category,
+            'address': selected_place['vicinity'],
+            'place_id': selected_place['place_id'],
         })
+    return activities
         
-        if resp.status_code != 200:
-            raise Exception(f"Google Places API error: {resp.status_code}")
-                            
-        places = resp.json().get('results', [])
-        if places:
-            # Randomly select a place from the results
-            selected_place = random.choice(places)
-            # retrieve the details of the selected place
-            details_resp = requests.get('https://maps.googleapis.com/maps/api/place/details/json', params={
-                'place_id': selected_place['place_id'],
-                'key': GOOGLE_MAPS_API_KEY
-            })
-            
-            place_details = details_resp.json().get('result', {})
-            
-            # Create a new Activity object and save it to the database
-            new_activity = Activity(
-                title = selected_place['name'],
-                itinerary_id=itinerary.id, # Associate with the current itinerary
-                user_id=itinerary.user_id,
-                category=category,
-                address=selected_place['vicinity'],
-                activity_url=place_details.get('url', None),
-                summary=place_details.get('editorial_summary', {}).get('overview', None)
-            )
-            db.session.add(new_activity)
+def search_categories(itinerary, categories, deadline):
+    """Searches every distinct category of the itinerary concurrently and yields (category, activities, error) as soon as each search is done.
+    A category whose search failed is yielded with the error instead of its activities, and categories that are not done
+    before the deadline are yielded last with DeadlineExceeded."""
+    # itineraries created before coordinates were stored are geocoded once and updated
+    if itinerary.latitude is None or itinerary.longitude is None:
+        itinerary.latitude, itinerary.longitude = get_long_lat(itinerary.location, deadline=deadline)
+        db.session.commit()
+    
+    # Each category picks as many places as it was chosen. Only the Google requests run in the
+    # worker threads; the callers do the database work in the request's session.
+    location, radius = (itinerary.latitude, itinerary.longitude), itinerary.radius
+    category_counts = Counter(categories)
+    
+    # categories with enough fresh places nearby in the places table are picked from them without searching Google
+    indexed = {}
+    for category, count in category_counts.items():
+        places = Place.nearby(location, radius, category, app.config['PLACE_INDEX_TTL'])
+        if len(places) >= max(count, app.config['PLACE_INDEX_MIN_CANDIDATES']):
+            place_index_stats['hits'] += 1
+            indexed[category] = [place.to_result() for place in places]
+        else:
+            place_index_stats['misses'] += 1
+    
+    # the places of the user's other activities are left out while there are others to pick from
+    seen = seen_places.get(itinerary.user_id)
+    
+    max_workers = min(len(category_counts), app.config['MAX_ACTIVITY_WORKERS']) or 1
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {
+        executor.submit(find_activities, location, radius, category, count, deadline, indexed.get(category), seen): category
+        for category, count in category_counts.items()
+    }
+    try:
+        for future in as_completed(futures, timeout=max(deadline.remaining(), 0)):
+            category = futures.pop(future)
+            try:
+                yield category, future.result(), None
+            except Exception as e:
+                yield category, None, e
+    except FuturesTimeoutError:
+        pass
+    finally:
+        # searches that are still running give up at the deadline on their own, so there is no need to wait for them
+        executor.shutdown(wait=False, cancel_futures=True)
+    
+    for category in futures.values():
+        yield category, None, DeadlineExceeded(f"The {deadline.seconds} second deadline has passed.")
+
+def save_activity(itinerary, fields):
+    """Adds an activity to the itinerary in its own savepoint and returns it, so that a failed insert does not roll back the others"""
+    # The place is usually stored by its search already. It is looked up before the savepoint so that, on SQLite,
+    # the transaction does not hold a read lock while it waits for a search that is saving places to finish writing.
+    place = db.session.get(Place, fields['place_id'])
+    with db.session.begin_nested():
+        if place is None:
+            place = Place.add(fields['place_id'], fields['title'], fields['address'])
+        activity = Activity(itinerary_id=itinerary.id, user_id=itinerary.user_id, category=fields['category'], place=place)
+        db.session.add(activity)
+    return activity
+
+def category_error(category, error):
+    """Logs why the category failed and returns a message about it that can be shown to the user. Database and request
+    errors can contain SQL, parameters or the api key, so only the messages of GoogleMapsUnavailable are passed on."""
+    if isinstance(error, GoogleMapsUnavailable):
+        app.logger.warning("Adding %s activities failed: %s", category, error)
+        return str(error)
+    app.logger.error("Adding %s activities failed", category, exc_info=error)
+    return f"The {category} activities could not be added. Please try again."
+
+def process_activities(itinerary, categories):
+    """Processes the categories given by the user to return random activities. Every category that succeeded is saved even if others did not.
+    Returns {"activity_ids": the new activities, "skipped": categories that ran out of time, "failed": {category: message} for the ones that failed,
+    "empty": categories with no places nearby}, so that only the skipped and failed categories need to be retried."""
+    deadline = Deadline(app.config['ACTIVITY_DEADLINE'])
+    activities_by_category = {}
+    errors = {}
+    for category, activities, error in search_categories(itinerary, categories, deadline):
+        activities_by_category[category] = activities or []
+        if error:
+            errors[category] = error
+    
+    # nothing was found, so report that Google is unavailable rather than a list of failures
+    unavailable = [e for e in errors.values() if isinstance(e, GoogleMapsUnavailable) and not isinstance(e, DeadlineExceeded)]
+    if unavailable and len(unavailable) == len(activities_by_category):
+        raise unavailable[0]
+    empty = [category for category, activities in activities_by_category.items() if not activities and category not in errors]
+    
+    # add the activities in the order the categories were given
+    new_activities = []
+    for category in categories:
+        if activities_by_category[category]:
+            try:
+                new_activities.append(save_activity(itinerary, activities_by_category[category].pop(0)))
+            except SQLAlchemyError as e:
+                errors.setdefault(category, e)
     
     # Commit the changes to save all activities
     db.session.commit()
+    prefetch_place_details([activity.id for activity in new_activities])
+    return {
+        "activity_ids": [activity.id for activity in new_activities],
+        "skipped": [category for category, e in errors.items() if isinstance(e, DeadlineExceeded)],
+        "failed": {category: category_error(category, e) for category, e in errors.items() if not isinstance(e, DeadlineExceeded)},
+        "empty": empty,
+    }
+
+def stream_activities(itinerary, categories):
+    """Yields (category, new activities, error) for each distinct category as soon as its search is done and its activities are saved.
+    A category that could not be searched or saved is yielded with the error instead and does not stop the others."""
+    deadline = Deadline(app.config['ACTIVITY_DEADLINE'])
+    for category, activities, error in search_categories(itinerary, categories, deadline):
+        if error:
+            yield category, None, error
+            continue
+        try:
+            new_activities = [save_activity(itinerary, fields) for fields in activities]
+            db.session.commit()
+            prefetch_place_details([activity.id for activity in new_activities])
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            yield category, None, e
+            continue
+        yield category, new_activities, None
+
+def reroll_activity(activity):
+    """Replaces the activity with another place found for its category near the itinerary that is not in the itinerary yet,
+    preferring places the user has no activity for. The places already found by searches are tried before searching Google again.
+    Returns False if there is no other place."""
+    itinerary = activity.itinerary
+    if itinerary.latitude is None or itinerary.longitude is None:
+        itinerary.latitude, itinerary.longitude = get_long_lat(itinerary.location)
+        db.session.commit()
+    location, radius = (itinerary.latitude, itinerary.longitude), itinerary.radius
+    key = nearby_search_key(location, radius, activity.category, app.config['NEARBY_GEOHASH_PRECISION'])
+    exclude = {other.place_id for other in itinerary.activities if other.place_id}
+    seen = seen_places.get(activity.user_id)
+    
+    # the cached search results, then the places table, then a new search (which is usually cached too)
+    sources = (
+        lambda: within_radius(nearby_cache.get(key) or [], location, radius),
+        lambda: [place.to_result() for place in Place.nearby(location, radius, activity.category, app.config['PLACE_INDEX_TTL'])],
+        lambda: nearby_search(location, radius, activity.category, deadline=Deadline(app.config['ACTIVITY_DEADLINE'])),
+    )
+    rng = selection.rng_for(key)
+    for source in sources:
+        picks = selection.select_fresh(source(), 1, seen, exclude, rng)
+        if picks:
+            break
+    else:
+        return False
+    
+    place = picks[0]
+    Place.get_or_add(place['place_id'], place['name'], place['vicinity'])
+    activity.place_id = place['place_id']
+    db.session.commit()
+    prefetch_place_details([activity.id])
+    return True
 
+def run_activity_job(job, itinerary_id, categories):
+    """Generates the activities of a background job and returns the url of the itinerary with the new, skipped, failed and empty categories.
+    The activities and failures of each category are saved on the job as soon as it is done, so that they can be streamed."""
+    itinerary = Itinerary.query.get(itinerary_id)
+    skipped, empty = [], []
+    for category, activities, error in stream_activities(itinerary, categories):
+        # the JSON columns are assigned new values so that the changes are saved
+        if isinstance(error, DeadlineExceeded):
+            skipped.append(category)
+        elif error:
+            job.failed = {**job.failed, category: category_error(category, error)}
+        elif activities:
+            job.activity_ids = job.activity_ids + [activity.id for activity in activities]
+        else:
+            empty.append(category)
+        job.advance()
+    return {"redirect_url": f"/itinerary/{itinerary_id}", "activity_ids": job.activity_ids, "skipped": skipped, "failed": job.failed, "empty": empty}
+        
+def add_activities_response(itinerary, categories, respond_async):
+    """Adds the activities for the categories, or queues a job to add them, and returns the (body, status, headers) of the response"""
+    # clients that prefer not to wait get a job id to poll instead
+    if respond_async:
+        job = job_queue.submit(run_activity_job, itinerary.user_id, len(set(categories)), itinerary.id, categories)
+        return {"job_id": job.id, "status_url": url_for('job_status', job_id=job.id), "events_url": url_for('job_events', job_id=job.id)}, 202, {}
+    
+    try:
+        result = process_activities(itinerary, categories)
+    except GoogleMapsUnavailable as e:
+        db.session.rollback()
+        return {"error": str(e)}, 503, {"Retry-After": "5"}
+    return {"message": "Activities added successfully", "redirect_url": f"/itinerary/{itinerary.id}", **result}, 200, {}
+        
 # routes
 @app.route('/')
 def homepage():
@@ -187,16 +670,31 @@ def create_itinerary():
         location = request.form['location']
         radius = request.form['radius'] 
         notes = request.form.get('notes')
+        # coordinates of the location selected in the place picker
+        latitude = request.form.get('latitude')
+        longitude = request.form.get('longitude')
         
         # Make sure that all of the required inputs are filled out
         if not title or not location or not radius:
             flash("Please fill in the required fields", 'danger')
             return render_template('itinerary/new.html', api_key=GOOGLE_MAPS_API_KEY)
         
+        # Geocode the location only if the place picker did not send its coordinates
+        try:
+            if latitude and longitude:
+                latitude, longitude = float(latitude), float(longitude)
+            else:
+                latitude, longitude = get_long_lat(location)
+        except Exception:
+            flash("Could not find that location. Please try another one.", 'danger')
+            return render_template('itinerary/new.html', api_key=GOOGLE_MAPS_API_KEY)
+        
         try:
             new_itinerary=Itinerary(
                 title = title,
                 location = location,
+                latitude = latitude,
+                longitude = longitude,
                 notes = notes or None,
                 radius= int(radius) * 1000,
                 user_id = g.user.id
@@ -217,6 +715,9 @@ def show_itinerary(itinerary_id):
     """Renders the itinerary page where it lists the activities if there are any"""
     # query the selected itinerary
     itinerary = Itinerary.query.get(itinerary_id)
+    # the details of activities that were not prefetched yet are loaded the first time they are shown
+    if itinerary:
+        load_place_details(itinerary.activities, Deadline(app.config['DETAILS_DEADLINE']))
     
     return render_template('itinerary/show.html', itinerary=itinerary)
     
@@ -239,12 +740,93 @@ def add_activities(itinerary_id):
         if not categories:
             return jsonify({"error": "Please select at least one activity category."}), 400
         
-        process_activities(itinerary, categories)
-        return jsonify({"message": "Activities added successfully", "redirect_url": f"/itinerary/{itinerary_id}"})
+        respond_async = request.headers.get('Prefer') == 'respond-async'
+        
+        # a retry of a request with the same Idempotency-Key gets the first response instead of adding the activities again
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key and len(idempotency_key) > IdempotencyKey.key.type.length:
+            return jsonify({"error": f"The Idempotency-Key must be at most {IdempotencyKey.key.type.length} characters long."}), 400
+        if idempotency_key:
+            request_hash = hashlib.sha256(json.dumps([itinerary_id, categories, respond_async]).encode('utf-8')).hexdigest()
+            entry, created = IdempotencyKey.claim(g.user.id, idempotency_key, request_hash, app.config['IDEMPOTENCY_TTL'], app.config['IDEMPOTENCY_LEASE'])
+            if not created:
+                if entry.request_hash != request_hash:
+                    return jsonify({"error": "This Idempotency-Key was already used for a different request."}), 422
+                if entry.status_code is None:
+                    return jsonify({"error": "A request with this Idempotency-Key is still being processed."}), 409, {"Retry-After": "1"}
+                return jsonify(entry.response), entry.status_code, {"Idempotent-Replayed": "true"}
+        
+        try:
+            body, status, headers = add_activities_response(itinerary, categories, respond_async)
+        except Exception:
+            if idempotency_key:
+                db.session.rollback()
+                entry.release()
+            raise
+        
+        if idempotency_key:
+            # server errors are not stored so that the request can be retried
+            if status < 500:
+                entry.complete(status, body, body.get('activity_ids'))
+            else:
+                entry.release()
+        return jsonify(body), status, headers
     
     # Renders the new activity form upon a get request
     return render_template('activity/new.html', itinerary=itinerary)
 
+@app.route('/jobs/<job_id>', methods=["GET"])
+@login_required
+def job_status(job_id):
+    """Returns the progress of a background job, and the redirect url once it is done"""
+    job = job_queue.get(job_id)
+    
+    # users can only see their own jobs
+    if job is None or job.user_id != g.user.id:
+        return jsonify({"error": "Job not found."}), 404
+    
+    return jsonify(job.to_dict())
+
+@app.route('/jobs/<job_id>/events', methods=["GET"])
+@login_required
+def job_events(job_id):
+    """Sends each activity saved by a background job, and each category that failed, as a server-sent event until the job is done.
+    The stream only reads the job, so opening it again, e.g. after a reload, does not add anything."""
+    job = job_queue.get(job_id)
+    
+    # users can only follow their own jobs
+    if job is None or job.user_id != g.user.id:
+        return jsonify({"error": "Job not found."}), 404
+    
+    def events():
+        sent_ids, sent_failed = set(), set()
+        give_up = time.monotonic() + app.config['JOB_STREAM_TIMEOUT']
+        while True:
+            # the job is run by another thread or process, so it is read again from the database every time
+            db.session.close()
+            job = db.session.get(Job, job_id)
+            new_ids = [activity_id for activity_id in job.activity_ids if activity_id not in sent_ids]
+            # activities that were deleted in the meantime are not sent
+            for activity in Activity.query.filter(Activity.id.in_(new_ids)).order_by(Activity.id) if new_ids else []:
+                yield f"event: activity\ndata: {json.dumps(activity.to_dict())}\n\n"
+            sent_ids.update(new_ids)
+            for category, error in job.failed.items():
+                if category not in sent_failed:
+                    sent_failed.add(category)
+                    yield f"event: failed\ndata: {json.dumps({'category': category, 'error': error})}\n\n"
+            
+            if job.status == 'done':
+                yield f"event: done\ndata: {json.dumps(job.result)}\n\n"
+                return
+            if job.status == 'failed' or time.monotonic() > give_up:
+                error = job.error or "Finding activities is taking longer than expected. Please check the itinerary again later."
+                yield f"event: done\ndata: {json.dumps({'error': error})}\n\n"
+                return
+            time.sleep(app.config['JOB_STREAM_INTERVAL'])
+    
+    # X-Accel-Buffering stops proxies from holding the events back until the response ends
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/logout')
 @login_required
 def logout():
@@ -271,6 +853,31 @@ def activity_delete(activity_id):
     flash("Activity removed.")
     return redirect(f"/itinerary/{itinerary_id}")
 
+@app.route('/activity/<int:activity_id>/reroll', methods=["POST"])
+@login_required
+def activity_reroll(activity_id):
+    """Replaces the activity with another one of the same category"""
+    activity = Activity.query.get_or_404(activity_id)
+    itinerary_id = activity.itinerary_id
+    
+    # ensures that another user cannot change another user's activity
+    if activity.user_id != g.user.id:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+    
+    try:
+        rerolled = reroll_activity(activity)
+    except Exception:
+        db.session.rollback()
+        flash("Could not find another activity right now. Please try again later.", "danger")
+        return redirect(f"/itinerary/{itinerary_id}")
+    
+    if rerolled:
+        flash("Activity replaced.")
+    else:
+        flash(f"There are no other {activity.category} activities nearby.", "danger")
+    return redirect(f"/itinerary/{itinerary_id}")
+
 @app.route('/itinerary/<int:itinerary_id>/delete', methods=["POST"])
 @login_required
 def itinerary_delete(itinerary_id):
@@ -291,5 +898,21 @@ def itinerary_delete(itinerary_id):
 @login_required
 def show_activities():
     """Renders a list of all the current user's activities"""
-    activities = Activity.query.filter(Activity.user_id==g.user.id)
-    return render_template('/activity/show.html', activities=activities)
\ No newline at end of file
+    activities = Activity.query.filter(Activity.user_id==g.user.id).all()
+    load_place_details(activities, Deadline(app.config['DETAILS_DEADLINE']))
+    return render_template('/activity/show.html', activities=activities)
+
+
+@app.route('/stats', methods=['GET'])
+@login_required
+def show_stats():
+    """Returns the cache, request coalescing and Google Maps client statistics as JSON"""
+    return jsonify({
+        "google_maps": maps_client.stats(),
+        "geocode_cache": {**geocode_cache.stats(), "database_hits": geocode_db_stats['hits'], "database_misses": geocode_db_stats['misses']},
+        "nearby_cache": nearby_cache.stats(),
+        "details_cache": details_cache.stats(),
+        "place_index": place_index_stats,
+        "seen_places": seen_places.stats(),
+        "coalesced_requests": google_requests.stats()
+    })
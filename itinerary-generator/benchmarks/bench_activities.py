@@ -0,0 +1,163 @@
+"""Latency benchmark of POST /itinerary/<id>/new against the local Google Maps stub.
+
+For every combination of category count and concurrency level, the benchmark sends requests from that many
+threads at once and reports the throughput and the p50/p95/p99 latency. Each request searches a new random
+location, so the caches do not hide the Google requests unless --warm is given.
+
+The benchmark writes to the database, so it has to be given one of its own with --database-url or BENCH_DATABASE_URL.
+It refuses to run against the app's database, and deletes its user, itineraries, activities and stub places when it ends.
+"""
+
+#    createdb spontinerary-bench
+#    BENCH_DATABASE_URL=postgresql:///spontinerary-bench python3 -m benchmarks.bench_activities --categories 1,3,5 --concurrency 1,4,16 --requests 50
+
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.maps_stub import StubConfig, start_stub
+
+# the database the app uses when SUPABASE_DB_URL is not set
+APP_DATABASE_URL = "postgresql:///spontinerary"
+ACTIVITY_CAT = ["Food", "Hiking", "Tours", "Shopping", "Adventure", "Outdoors", "Culture", "Relaxation", "Music", "Fitness"]
+
+
+def percentile(values, percent):
+    """Returns the nearest-rank percentile of the values"""
+    ordered = sorted(values)
+    rank = max(1, round(percent / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def parse_list(value):
+    """Parses a comma separated list of integers"""
+    return [int(item) for item in value.split(",")]
+
+
+def setup_itineraries(app, db, User, Itinerary, count):
+    """Creates a benchmark user with one itinerary per worker thread and returns (user id, itinerary ids)"""
+    db.create_all()
+    user = User.query.filter_by(username="benchmark").first() or User.register(
+        username="benchmark", email="benchmark@example.com", password="benchmark", image_url=None
+    )
+    db.session.commit()
+    itineraries = [
+        Itinerary(title=f"Benchmark {i}", location="Benchmark", latitude=41.89, longitude=-87.61, radius=10000, user_id=user.id)
+        for i in range(count)
+    ]
+    db.session.add_all(itineraries)
+    db.session.commit()
+    return user.id, [itinerary.id for itinerary in itineraries]
+
+
+def cleanup(db, User, Place, user_id):
+    """Deletes the benchmark user with its itineraries, activities and jobs, and the places made up by the stub"""
+    db.session.rollback()
+    user = db.session.get(User, user_id)
+    if user:
+        db.session.delete(user)
+        db.session.commit()
+    Place.query.filter(Place.place_id.like("stub-%")).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def run(app, db, Itinerary, CURR_USER_KEY, user_id, itinerary_ids, categories, concurrency, total, warm, seed=None):
+    """Sends total requests with concurrency threads and returns (latencies in ms, errors, elapsed seconds)"""
+    clients = []
+    for i in range(concurrency):
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+        clients.append(client)
+
+    def worker(index):
+        # every worker thread sends its share of the requests one after another to its own itinerary
+        itinerary_id = itinerary_ids[index]
+        results = []
+        for i in range(index, total, concurrency):
+            # with a seed each request gets its own generator, so the locations do not depend on the order the threads run in
+            rng = random.Random(f"{seed}|{len(categories)}|{concurrency}|{i}") if seed is not None else random
+            if not warm:
+                # move the itinerary to a new place so that every search misses the caches
+                with app.app_context():
+                    itinerary = Itinerary.query.get(itinerary_id)
+                    itinerary.latitude = rng.uniform(-60, 60)
+                    itinerary.longitude = rng.uniform(-180, 180)
+                    db.session.commit()
+            start = time.perf_counter()
+            response = clients[index].post(f"/itinerary/{itinerary_id}/new", json={'categories': categories})
+            results.append(((time.perf_counter() - start) * 1000, response.status_code))
+        return results
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = [result for worker_results in executor.map(worker, range(concurrency)) for result in worker_results]
+    elapsed = time.perf_counter() - start
+
+    latencies = [latency for latency, status in results if status == 200]
+    errors = sum(1 for latency, status in results if status != 200)
+    return latencies, errors, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--categories', type=parse_list, default=[1, 3, 5], help="category counts, e.g. 1,3,5")
+    parser.add_argument('--concurrency', type=parse_list, default=[1, 4, 16], help="concurrency levels, e.g. 1,4,16")
+    parser.add_argument('--requests', type=int, default=50, help="requests per combination")
+    parser.add_argument('--latency-ms', type=float, default=100, help="median latency of the stub")
+    parser.add_argument('--sigma', type=float, default=0.5, help="spread of the stub's log-normal latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of stub requests that fail")
+    parser.add_argument('--results', type=int, default=20, help="places returned by each nearby search")
+    parser.add_argument('--warm', action='store_true', help="search the same location every time so the caches are used")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the random locations, latencies and activity picks")
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'),
+                        help="database the benchmark may write to (default: BENCH_DATABASE_URL)")
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("give a database of its own to the benchmark with --database-url or BENCH_DATABASE_URL")
+    if args.database_url in (APP_DATABASE_URL, os.environ.get('SUPABASE_DB_URL')):
+        parser.error("the benchmark writes to the database, so it cannot run against the app's database")
+
+    random.seed(args.seed)
+    stub = start_stub(StubConfig(args.latency_ms, args.sigma, args.error_rate, args.results))
+    # the app reads these when it is imported
+    os.environ['SUPABASE_DB_URL'] = args.database_url
+    os.environ['GOOGLE_MAPS_BASE_URL'] = stub.url
+    os.environ.setdefault('GOOGLE_MAPS_API_KEY', "benchmark")
+    if args.seed is not None:
+        os.environ['ACTIVITY_SEED'] = str(args.seed)
+    from app import app, db, CURR_USER_KEY
+    from models import User, Itinerary, Place
+    app.config['DEBUG_TB_ENABLED'] = False
+
+    user_id, itinerary_ids = setup_itineraries(app, db, User, Itinerary, max(args.concurrency))
+    try:
+        benchmark(app, db, Itinerary, CURR_USER_KEY, user_id, itinerary_ids, args)
+    finally:
+        cleanup(db, User, Place, user_id)
+        stub.shutdown()
+
+
+def benchmark(app, db, Itinerary, CURR_USER_KEY, user_id, itinerary_ids, args):
+    """Runs every combination of category count and concurrency level and prints a row of results for each"""
+    print(f"stub: median {args.latency_ms}ms, sigma {args.sigma}, error rate {args.error_rate}, {args.results} results")
+    print(f"{'categories':>10} {'concurrency':>11} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for category_count in args.categories:
+        categories = [ACTIVITY_CAT[i % len(ACTIVITY_CAT)] for i in range(category_count)]
+        for concurrency in args.concurrency:
+            latencies, errors, elapsed = run(
+                app, db, Itinerary, CURR_USER_KEY, user_id, itinerary_ids, categories, concurrency, args.requests, args.warm, args.seed
+            )
+            if latencies:
+                p50, p95, p99 = (percentile(latencies, p) for p in (50, 95, 99))
+            else:
+                p50 = p95 = p99 = float('nan')
+            print(f"{category_count:>10} {concurrency:>11} {args.requests:>8} {errors:>6} "
+                  f"{args.requests / elapsed:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""A local stand-in for the Google Maps geocode, nearby search and details endpoints.
+
+It answers with made up places after a random delay, so that activity generation can be measured without
+spending API quota. Point the app at it with GOOGLE_MAPS_BASE_URL=http://127.0.0.1:<port>.
+"""
+
+#    python3 -m benchmarks.maps_stub --port 8765 --latency-ms 100 --sigma 0.5 --error-rate 0.01 --results 20
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+ENDPOINTS = {
+    "/maps/api/geocode/json": 'geocode',
+    "/maps/api/place/nearbysearch/json": 'nearbysearch',
+    "/maps/api/place/details/json": 'details',
+}
+
+
+class StubConfig:
+    """How the stub behaves. Latencies follow a log-normal distribution around median_ms with the given sigma
+    (0 gives a fixed latency); error_rate of the requests fail with a 500."""
+
+    def __init__(self, median_ms=100, sigma=0.5, error_rate=0.0, result_count=20, endpoint_median_ms=None):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.result_count = result_count
+        # overrides of median_ms for single endpoints, e.g. {'nearbysearch': 300}
+        self.endpoint_median_ms = endpoint_median_ms or {}
+        self.requests = {endpoint: 0 for endpoint in ENDPOINTS.values()}
+        self._lock = threading.Lock()
+
+    def latency(self, endpoint):
+        """Returns a random latency in seconds for a request to the endpoint"""
+        median_ms = self.endpoint_median_ms.get(endpoint, self.median_ms)
+        return median_ms * math.exp(random.gauss(0, self.sigma)) / 1000
+
+    def count(self, endpoint):
+        """Counts a request to the endpoint"""
+        with self._lock:
+            self.requests[endpoint] += 1
+
+
+def geocode_response(params):
+    """Returns the same made up coordinates for every address"""
+    return {'status': 'OK', 'results': [{'geometry': {'location': {'lat': 41.892654, 'lng': -87.610168}}}]}
+
+
+def nearby_search_response(params, result_count):
+    """Returns result_count made up places around the location, the same ones for the same location and keyword"""
+    lat, lng = (float(value) for value in params['location'].split(","))
+    keyword = params.get('keyword', "place")
+    places = []
+    for i in range(result_count):
+        # seed on the search so that repeated searches return the same places
+        rng = random.Random(f"{params['location']}|{keyword}|{i}")
+        place_id = f"stub-{keyword}-{rng.getrandbits(48):012x}"
+        places.append({
+            'place_id': place_id,
+            'name': f"{keyword.title()} Place {i + 1}",
+            'vicinity': f"{rng.randint(1, 9999)} Stub St",
+            'geometry': {'location': {'lat': lat + rng.uniform(-0.05, 0.05), 'lng': lng + rng.uniform(-0.05, 0.05)}},
+            'rating': round(rng.uniform(1, 5), 1),
+            'user_ratings_total': rng.randint(0, 5000),
+            'types': [keyword.lower(), "point_of_interest"],
+        })
+    return {'status': 'OK' if places else 'ZERO_RESULTS', 'results': places}
+
+
+def details_response(params):
+    """Returns made up details for the place"""
+    place_id = params['place_id']
+    return {'status': 'OK', 'result': {
+        'url': f"https://maps.google.com/?cid={place_id}",
+        'editorial_summary': {'overview': f"A made up summary of {place_id}."},
+    }}
+
+
+def make_handler(config):
+    """Returns a request handler class that answers with the config"""
+
+    class MapsStubHandler(BaseHTTPRequestHandler):
+        """Answers the Google Maps endpoints that the app uses."""
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            endpoint = ENDPOINTS.get(url.path)
+            if endpoint is None:
+                self.send_json(404, {'status': 'NOT_FOUND'})
+                return
+
+            config.count(endpoint)
+            time.sleep(config.latency(endpoint))
+            if random.random() < config.error_rate:
+                self.send_json(500, {'status': 'UNKNOWN_ERROR'})
+                return
+
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if endpoint == 'geocode':
+                self.send_json(200, geocode_response(params))
+            elif endpoint == 'nearbysearch':
+                self.send_json(200, nearby_search_response(params, config.result_count))
+            else:
+                self.send_json(200, details_response(params))
+
+        def send_json(self, status, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # keep benchmark output readable
+            pass
+
+    return MapsStubHandler
+
+
+def start_stub(config=None, host="127.0.0.1", port=0):
+    """Starts the stub on a background thread and returns the server. Its url is server.url and its config is server.config."""
+    config = config or StubConfig()
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    # the client keeps connections alive, so the handler threads must not block shutdown
+    server.daemon_threads = True
+    server.config = config
+    server.url = f"http://{host}:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=100, help="median latency of every endpoint")
+    parser.add_argument('--sigma', type=float, default=0.5, help="spread of the log-normal latency, 0 for a fixed latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests that fail with a 500")
+    parser.add_argument('--results', type=int, default=20, help="number of places returned by each nearby search")
+    args = parser.parse_args()
+
+    config = StubConfig(args.latency_ms, args.sigma, args.error_rate, args.results)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config))
+    print(f"Google Maps stub listening on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,238 @@
+"""In-process caches for Google Maps responses and the geohash helpers used to key them."""
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+# nearby search radii (in meters) are rounded up to one of these so that similar searches share a cache entry.
+# The last one is the largest radius Google allows for a nearby search.
+RADIUS_BUCKETS = [1000, 2000, 5000, 10000, 20000, 50000]
+EARTH_RADIUS_M = 6371000
+
+
+def geohash(latitude, longitude, precision=6):
+    """Encodes the coordinates as a geohash with the given number of characters"""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, bit_count, even = [], 0, 0, True
+    while len(chars) < precision:
+        # even bits split the longitude range and odd bits split the latitude range
+        value_range, value = (lng_range, longitude) if even else (lat_range, latitude)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = bit_count = 0
+    return "".join(chars)
+
+
+def geohash_cells(latitude, longitude, radius, max_cells=16):
+    """Returns the geohash cells that cover the circle of radius meters around the coordinates,
+    using the longest geohashes that keep the number of cells at or below max_cells"""
+    lat_delta = math.degrees(radius / EARTH_RADIUS_M)
+    lng_delta = lat_delta / max(math.cos(math.radians(latitude)), 0.01)
+    south, north = max(latitude - lat_delta, -90.0), min(latitude + lat_delta, 90.0)
+    west, east = max(longitude - lng_delta, -180.0), min(longitude + lng_delta, 180.0)
+    
+    for precision in range(9, 0, -1):
+        # a geohash of n characters has 5n bits, split between longitude (the extra odd bit) and latitude
+        lng_cells, lat_cells = 2 ** ((5 * precision + 1) // 2), 2 ** (5 * precision // 2)
+        width, height = 360 / lng_cells, 180 / lat_cells
+        columns = range(int((west + 180) // width), min(int((east + 180) // width), lng_cells - 1) + 1)
+        rows = range(int((south + 90) // height), min(int((north + 90) // height), lat_cells - 1) + 1)
+        if len(columns) * len(rows) <= max_cells:
+            break
+    
+    # the geohash of each cell's center is the cell itself
+    return sorted({
+        geohash(-90 + (row + 0.5) * height, -180 + (column + 0.5) * width, precision)
+        for column in columns for row in rows
+    })
+
+
+def distance(a, b):
+    """Returns the great-circle distance in meters between two (latitude, longitude) points"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (*a, *b))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(h))
+
+
+def quantize_radius(radius):
+    """Rounds the radius up to the closest bucket, or down to the largest bucket Google allows. A search with the bucket
+    covers the whole radius up to that limit, and its results are cut back to the radius with within_radius."""
+    return min([bucket for bucket in RADIUS_BUCKETS if bucket >= radius], default=RADIUS_BUCKETS[-1])
+
+
+def within_radius(places, location, radius):
+    """Returns the nearby search results that are at most radius meters from the (latitude, longitude) location"""
+    return [
+        place for place in places
+        if distance(location, (place['geometry']['location']['lat'], place['geometry']['location']['lng'])) <= radius
+    ]
+
+
+def nearby_search_key(location, radius, keyword, precision=6):
+    """Returns the cache key of a nearby search from the geohash of the location, the radius bucket and the keyword"""
+    return (geohash(location[0], location[1], precision), quantize_radius(radius), keyword.strip().lower())
+
+
+class TTLCache:
+    """A thread-safe least recently used cache whose entries expire after a time to live (in seconds)."""
+
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the value stored under the key, or the default if it is missing or expired"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self.misses += 1
+                return default
+            # mark the key as the most recently used
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key, default=None):
+        """Returns the value stored under the key even if it has expired, or the default if it was evicted"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        """Stores the value under the key, evicting the least recently used entry if the cache is full"""
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Removes the key from the cache if it is there"""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry and resets the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Returns the hit/miss counters and size of the cache"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+
+class SeenPlaces:
+    """How many of each user's activities are at each place_id. A user's counts are loaded once with load(user_id), which
+    returns the place_id of every activity, and then kept up to date with add and discard as activities are saved and deleted.
+    Counting keeps a place seen until the last of the user's activities there is gone. The ttl bounds how long changes
+    made by other processes go unseen."""
+
+    def __init__(self, load, maxsize=10000, ttl=600):
+        self.load = load
+        self.users = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Returns a frozenset of the place_ids of the user's activities, loading them the first time"""
+        counts = self.users.get(user_id)
+        if counts is None:
+            counts = Counter(self.load(user_id))
+            self.users.set(user_id, counts)
+        with self._lock:
+            return frozenset(counts)
+
+    def add(self, user_id, place_id):
+        """Counts one more activity at the place if the user is loaded. Otherwise it is loaded with the rest next time."""
+        with self._lock:
+            counts = self.users.get_stale(user_id)
+            if counts is not None:
+                counts[place_id] += 1
+
+    def discard(self, user_id, place_id):
+        """Counts one less activity at the place if the user is loaded, forgetting the place when none are left"""
+        with self._lock:
+            counts = self.users.get_stale(user_id)
+            if counts is not None and place_id in counts:
+                counts[place_id] -= 1
+                if counts[place_id] <= 0:
+                    del counts[place_id]
+
+    def clear(self):
+        """Forgets the ids of every user"""
+        self.users.clear()
+
+    def stats(self):
+        """Returns the hit/miss counters and number of users loaded"""
+        return self.users.stats()
+
+
+class SingleFlight:
+    """Collapses concurrent calls that share a key into one call whose result (or exception) is given to every caller."""
+
+    def __init__(self):
+        self.calls = 0
+        self.collapsed = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, deadline=None, **kwargs):
+        """Calls fn(*args, **kwargs), or waits for the call already in flight under the key and returns its result.
+        A caller with a Deadline passes it on to fn when it makes the call and raises DeadlineExceeded once it has passed
+        while waiting. A call that failed after its own deadline passed may have only run out of time, so the callers
+        waiting for it with time left call again instead of raising its error."""
+        if deadline is not None:
+            kwargs['deadline'] = deadline
+        while True:
+            with self._lock:
+                call = self._in_flight.get(key)
+                leader = call is None
+                if leader:
+                    call = self._in_flight[key] = {'done': threading.Event(), 'result': None, 'error': None, 'deadline': deadline}
+                    self.calls += 1
+                else:
+                    self.collapsed += 1
+            if leader:
+                break
+
+            while not call['done'].wait(deadline.remaining() if deadline else None):
+                deadline.check()
+            if call['error'] is None:
+                return call['result']
+            timed_out = call['deadline'] is not None and call['deadline'].expired()
+            if not timed_out or (deadline is not None and deadline.expired()):
+                raise call['error']
+
+        try:
+            call['result'] = fn(*args, **kwargs)
+            return call['result']
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call['done'].set()
+
+    def stats(self):
+        """Returns how many calls were made and how many were collapsed into a call already in flight"""
+        return {'calls': self.calls, 'collapsed': self.collapsed}
@@ -0,0 +1,494 @@
+"""Shared HTTP client for the Google Maps APIs."""
+import math
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FuturesTimeoutError
+
+import requests
+from requests.adapters import HTTPAdapter
+
+GOOGLE_MAPS_BASE_URL = "https://maps.googleapis.com"
+GOOGLE_MAPS_PATHS = {
+    'geocode': "/maps/api/geocode/json",
+    'nearbysearch': "/maps/api/place/nearbysearch/json",
+    'details': "/maps/api/place/details/json",
+}
+GOOGLE_MAPS_URLS = {endpoint: GOOGLE_MAPS_BASE_URL + path for endpoint, path in GOOGLE_MAPS_PATHS.items()}
+# (connect, read) timeouts in seconds for each endpoint
+DEFAULT_TIMEOUTS = {
+    'geocode': (3.05, 5),
+    'nearbysearch': (3.05, 10),
+    'details': (3.05, 5),
+}
+# responses with these status codes are retried
+RETRY_STATUSES = {500, 502, 503, 504}
+# (requests per second, burst) allowed for each endpoint
+DEFAULT_RATE_LIMITS = {
+    'geocode': (50, 50),
+    'nearbysearch': (50, 50),
+    'details': (50, 50),
+}
+# API statuses meaning Google will not answer the request right now: the quota is used up, the key was refused or Google failed
+REFUSED_STATUSES = {'OVER_QUERY_LIMIT', 'OVER_DAILY_LIMIT', 'REQUEST_DENIED', 'UNKNOWN_ERROR'}
+
+
+class GoogleMapsUnavailable(Exception):
+    """Raised instead of sending a request that Google Maps cannot take right now."""
+
+
+class RateLimitExceeded(GoogleMapsUnavailable):
+    """Raised when a request waited longer than allowed for the rate limiter."""
+
+
+class CircuitOpen(GoogleMapsUnavailable):
+    """Raised instead of sending a request while the circuit of its endpoint is open."""
+
+
+class RequestRefused(GoogleMapsUnavailable):
+    """Raised when Google Maps answers a request with a status saying that it will not serve it right now."""
+
+
+class DeadlineExceeded(GoogleMapsUnavailable):
+    """Raised instead of sending a request once the deadline of the work it belongs to has passed."""
+
+
+class Deadline:
+    """The time by which a piece of work has to finish, shared by every request made for it."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        """Returns the seconds left before the deadline, which is negative once it has passed"""
+        return self.expires - time.monotonic()
+
+    def expired(self):
+        """Returns whether the deadline has passed"""
+        return self.remaining() <= 0
+
+    def check(self):
+        """Raises DeadlineExceeded if the deadline has passed and returns the seconds left otherwise"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"The {self.seconds} second deadline has passed.")
+        return remaining
+
+
+class RateLimiter:
+    """Limits the requests to one endpoint with a token bucket and an adaptive limit on concurrent requests.
+    The concurrency limit is halved whenever Google throttles a request and grows back by one request
+    for every limit's worth of successful ones. Callers wait up to max_wait seconds for their turn."""
+
+    def __init__(self, rate, burst, max_concurrency=10, max_wait=5.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.max_wait = max_wait
+        self.concurrency = float(max_concurrency)
+        self.tokens = float(burst)
+        self.in_flight = 0
+        self.waits = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+        self.rejected = 0
+        self.throttled = 0
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        """Adds the tokens earned since the last refill"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, max_wait=None):
+        """Waits for a token and a free concurrency slot, raising RateLimitExceeded after max_wait seconds (default self.max_wait)"""
+        start = time.monotonic()
+        deadline = start + (self.max_wait if max_wait is None else min(max_wait, self.max_wait))
+        with self._condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1 and self.in_flight < int(self.concurrency):
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.rejected += 1
+                    raise RateLimitExceeded("Too many requests to Google Maps. Please try again.")
+                # wake up when the next token is due, or earlier if a request finishes
+                next_token = (1 - self.tokens) / self.rate if self.tokens < 1 else remaining
+                self._condition.wait(min(remaining, next_token))
+
+            waited_ms = (time.monotonic() - start) * 1000
+            if waited_ms >= 1:
+                self.waits += 1
+                self.total_wait_ms += waited_ms
+                self.max_wait_ms = max(self.max_wait_ms, waited_ms)
+
+    def try_acquire(self):
+        """Takes a token and a concurrency slot if both are free right now and returns whether it did, without waiting"""
+        with self._condition:
+            self._refill()
+            if self.tokens >= 1 and self.in_flight < int(self.concurrency):
+                self.tokens -= 1
+                self.in_flight += 1
+                return True
+            return False
+
+    def release(self, throttled=False):
+        """Frees the concurrency slot of a finished request and adapts the limit to whether it was throttled"""
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                self.concurrency = max(1.0, self.concurrency / 2)
+            else:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self._condition.notify_all()
+
+    def stats(self):
+        """Returns the wait times, rejections and current concurrency limit"""
+        with self._condition:
+            return {
+                'waits': self.waits,
+                'mean_wait_ms': round(self.total_wait_ms / self.waits, 2) if self.waits else 0.0,
+                'max_wait_ms': round(self.max_wait_ms, 2),
+                'rejected': self.rejected,
+                'throttled': self.throttled,
+                'concurrency_limit': int(self.concurrency),
+            }
+
+
+class CircuitBreaker:
+    """Stops sending requests to an endpoint that keeps failing or responding slowly. The circuit opens when at least
+    failure_rate of the last window requests failed or took longer than slow_ms, stays open for reset_timeout seconds
+    and then half-opens to let one trial request through, closing again if it succeeds. Requests that were sent before the
+    circuit last opened or closed say nothing about its current state, so their outcomes are ignored."""
+
+    def __init__(self, window=20, min_requests=5, failure_rate=0.5, slow_ms=3000, reset_timeout=30):
+        self.window = window
+        self.min_requests = min_requests
+        self.failure_rate = failure_rate
+        self.slow_ms = slow_ms
+        self.reset_timeout = reset_timeout
+        self.opened = 0
+        self._results = deque(maxlen=window)
+        self._opened_at = None
+        self._changed_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """'closed', 'open', or 'half_open' once the circuit has been open for reset_timeout seconds"""
+        if self._opened_at is None:
+            return 'closed'
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return 'half_open'
+        return 'open'
+
+    def allow(self):
+        """Returns whether a request may be sent, letting only one trial request through while half-open"""
+        with self._lock:
+            state = self.state
+            if state == 'half_open' and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return state == 'closed'
+
+    def record(self, success, elapsed_ms, sent_at=None):
+        """Records the outcome of a request sent at the time.monotonic() sent_at and opens or closes the circuit"""
+        failed = not success or elapsed_ms > self.slow_ms
+        with self._lock:
+            if sent_at is not None and self._changed_at is not None and sent_at < self._changed_at:
+                # a request that was already in flight when the circuit opened is not its trial
+                return
+            if self._opened_at is not None:
+                # the result of the trial request decides whether the circuit closes
+                self._trial_in_flight = False
+                if failed:
+                    self._opened_at = self._changed_at = time.monotonic()
+                else:
+                    self._opened_at = None
+                    self._changed_at = time.monotonic()
+                    self._results.clear()
+                return
+
+            self._results.append(failed)
+            if len(self._results) >= self.min_requests and sum(self._results) / len(self._results) >= self.failure_rate:
+                self._opened_at = self._changed_at = time.monotonic()
+                self.opened += 1
+
+    def cancel_trial(self):
+        """Lets another request be the trial of a half-open circuit when the allowed one was not sent"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def reset(self):
+        """Closes the circuit and forgets the recorded requests"""
+        with self._lock:
+            self._results.clear()
+            self._opened_at = None
+            self._changed_at = None
+            self._trial_in_flight = False
+
+    def stats(self):
+        """Returns the state of the circuit and how many times it opened"""
+        return {'state': self.state, 'opened': self.opened}
+
+
+class Hedger:
+    """Decides when to send a second copy of a slow request to an endpoint. A copy (a hedge) is sent once a request has
+    taken longer than the given percentile of the endpoint's last window latencies, as long as the hedges stay under
+    max_ratio of the requests. Nothing is hedged until min_samples latencies are known."""
+
+    def __init__(self, percentile=95, max_ratio=0.05, window=200, min_samples=20):
+        self.percentile = percentile
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.requests = 0
+        self.fired = 0
+        self.won = 0
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, elapsed_ms):
+        """Records the latency of a successful request"""
+        with self._lock:
+            self._latencies.append(elapsed_ms)
+
+    def delay(self):
+        """Returns the seconds to wait for a request before hedging it, or None if too few latencies are known"""
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[math.ceil(self.percentile / 100 * len(ordered)) - 1] / 1000
+
+    def start(self):
+        """Counts a request that may be hedged"""
+        with self._lock:
+            self.requests += 1
+
+    def allow(self):
+        """Returns whether a hedge may be sent without going over max_ratio of the requests, and counts it if so"""
+        with self._lock:
+            if self.fired + 1 > self.max_ratio * self.requests:
+                return False
+            self.fired += 1
+            return True
+
+    def cancel(self):
+        """Uncounts a hedge that was allowed but could not be sent"""
+        with self._lock:
+            self.fired -= 1
+
+    def record_win(self):
+        """Counts a hedge that answered before the request it copied"""
+        with self._lock:
+            self.won += 1
+
+    def stats(self):
+        """Returns how many hedges were sent and won and the current hedging delay"""
+        delay = self.delay()
+        return {
+            'fired': self.fired,
+            'won': self.won,
+            'delay_ms': round(delay * 1000, 2) if delay is not None else None,
+        }
+
+
+def is_throttled(response):
+    """Returns whether Google rejected the request for going over the query limit"""
+    return response.status_code == 429 or b'"OVER_QUERY_LIMIT"' in response.content
+
+
+def check_status(endpoint, response, statuses=('OK', 'ZERO_RESULTS')):
+    """Returns the JSON of a response whose status is one of statuses, OK or ZERO_RESULTS by default. Raises RequestRefused
+    if Google throttled, denied or failed the request, and an Exception for any other status, so that errors are never
+    mistaken for no results."""
+    if response.status_code == 429 or response.status_code in RETRY_STATUSES:
+        raise RequestRefused(f"Google Maps {endpoint} is unavailable ({response.status_code}). Please try again later.")
+    if response.status_code != 200:
+        raise Exception(f"Google Maps {endpoint} error: {response.status_code}")
+    data = response.json()
+    status = data.get('status')
+    if status in REFUSED_STATUSES:
+        raise RequestRefused(f"Google Maps {endpoint} refused the request ({status}). Please try again later.")
+    if status not in statuses:
+        raise Exception(f"Google Maps {endpoint} error: {status}")
+    return data
+
+
+class GoogleMapsClient:
+    """Sends GET requests to the Google Maps APIs over one pooled keep-alive session, with per endpoint timeouts,
+    rate limits, circuit breakers, hedging, jittered retries and latency statistics."""
+
+    def __init__(self, api_key, timeouts=None, retries=2, backoff=0.2, pool_size=20, rate_limits=None,
+                 max_concurrency=10, max_wait=5.0, circuit_breaker=None, hedging=None, base_url=GOOGLE_MAPS_BASE_URL):
+        self.api_key = api_key
+        # base_url can point at a stand-in server such as benchmarks/maps_stub.py
+        self.urls = {endpoint: base_url.rstrip("/") + path for endpoint, path in GOOGLE_MAPS_PATHS.items()}
+        self.timeouts = {**DEFAULT_TIMEOUTS, **(timeouts or {})}
+        self.limiters = {
+            endpoint: RateLimiter(rate, burst, max_concurrency, max_wait)
+            for endpoint, (rate, burst) in {**DEFAULT_RATE_LIMITS, **(rate_limits or {})}.items()
+        }
+        # circuit_breaker holds the keyword arguments of each endpoint's CircuitBreaker
+        self.breakers = {endpoint: CircuitBreaker(**(circuit_breaker or {})) for endpoint in GOOGLE_MAPS_URLS}
+        # hedging maps the endpoints whose slow requests are hedged to the keyword arguments of their Hedger
+        self.hedgers = {endpoint: Hedger(**options) for endpoint, options in (hedging or {}).items()}
+        # hedged requests and their copies are sent from these threads so that the caller can wait for the first answer
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='google-maps') if self.hedgers else None
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        # one pool per host; pool_size is the number of keep-alive connections kept open to it
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._stats = {endpoint: {'requests': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+                       for endpoint in GOOGLE_MAPS_URLS}
+        self._lock = threading.Lock()
+
+    def get(self, endpoint, params, deadline=None):
+        """Sends a GET request to the endpoint with the api key added to the params and returns the response.
+        Connection errors, timeouts, 5xx responses and throttled requests are retried with jittered exponential backoff.
+        Raises CircuitOpen without sending anything while the endpoint's circuit is open. When a Deadline is given,
+        the waits and timeouts are shortened to fit in it and DeadlineExceeded is raised once it has passed.
+        Slow requests to hedged endpoints are sent a second time and the first good response is returned."""
+        url = self.urls[endpoint]
+        params = {**params, 'key': self.api_key}
+        limiter = self.limiters[endpoint]
+        breaker = self.breakers[endpoint]
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._record(endpoint, 'retries')
+                # "full jitter": sleep a random time up to the exponential backoff
+                backoff = random.uniform(0, self.backoff * 2 ** attempt)
+                time.sleep(min(backoff, deadline.check()) if deadline else backoff)
+            timeout, remaining = self.timeouts[endpoint], None
+            if deadline:
+                remaining = deadline.check()
+                timeout = (min(timeout[0], remaining), min(timeout[1], remaining))
+            if not breaker.allow():
+                raise CircuitOpen(f"Google Maps {endpoint} is unavailable. Please try again later.")
+            try:
+                limiter.acquire(remaining)
+            except RateLimitExceeded:
+                # give the trial request back if the circuit let this one through as its trial
+                breaker.cancel_trial()
+                raise
+            try:
+                if endpoint in self.hedgers:
+                    response, failed = self._send_hedged(endpoint, url, params, timeout)
+                else:
+                    response, failed = self._send(endpoint, url, params, timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+                continue
+            # any other RequestException was recorded as a failure by _send and is not worth retrying
+            if not failed or attempt == self.retries:
+                return response
+
+    def _send(self, endpoint, url, params, timeout):
+        """Sends one request that already holds a rate limiter slot and returns (response, whether it failed).
+        Its outcome is recorded in the stats and the circuit breaker, and the errors raised by requests are raised."""
+        start, sent_at = time.perf_counter(), time.monotonic()
+        throttled = False
+        try:
+            response = self.session.get(url, params=params, timeout=timeout)
+            throttled = is_throttled(response)
+        except requests.RequestException:
+            self.breakers[endpoint].record(False, self._record(endpoint, 'errors', start), sent_at)
+            raise
+        except BaseException:
+            # anything else is not Google's doing, so a half-open circuit lets another request be its trial
+            self.breakers[endpoint].cancel_trial()
+            raise
+        finally:
+            self.limiters[endpoint].release(throttled)
+        failed = response.status_code in RETRY_STATUSES or throttled
+        elapsed_ms = self._record(endpoint, 'requests', start)
+        self.breakers[endpoint].record(not failed, elapsed_ms, sent_at)
+        if not failed and endpoint in self.hedgers:
+            self.hedgers[endpoint].record(elapsed_ms)
+        return response, failed
+
+    def _send_hedged(self, endpoint, url, params, timeout):
+        """Sends the request and, if it has not answered within the hedging delay, a copy of it. Returns the first
+        (response, failed) that did not fail, or the original request's outcome if neither succeeded."""
+        hedger = self.hedgers[endpoint]
+        delay = hedger.delay()
+        if delay is None:
+            return self._send(endpoint, url, params, timeout)
+        
+        hedger.start()
+        primary = self._executor.submit(self._send, endpoint, url, params, timeout)
+        try:
+            return primary.result(timeout=delay)
+        except FuturesTimeoutError:
+            pass
+        
+        # the copy is only sent if it stays within the budget and needs no waiting, so hedging never adds load on a struggling endpoint
+        if not (self.breakers[endpoint].state == 'closed' and hedger.allow()):
+            return primary.result()
+        if not self.limiters[endpoint].try_acquire():
+            hedger.cancel()
+            return primary.result()
+        hedge = self._executor.submit(self._send, endpoint, url, params, timeout)
+        
+        # the slower of the two keeps running in the background and is recorded when it finishes
+        for future in as_completed([primary, hedge]):
+            if future.exception() is None and not future.result()[1]:
+                if future is hedge:
+                    hedger.record_win()
+                return future.result()
+        return primary.result()
+
+    def circuit_state(self, endpoint):
+        """Returns the state of the endpoint's circuit: 'closed', 'open' or 'half_open'"""
+        return self.breakers[endpoint].state
+
+    def _record(self, endpoint, counter, start=None):
+        """Increments the counter of the endpoint and records and returns the latency of the request that began at start"""
+        with self._lock:
+            stats = self._stats[endpoint]
+            stats[counter] += 1
+            if start is not None:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                stats['total_ms'] += elapsed_ms
+                stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+                return elapsed_ms
+
+    def stats(self):
+        """Returns the request counts and latencies of each endpoint and the number of connections that were opened"""
+        endpoints = {}
+        with self._lock:
+            for endpoint, stats in self._stats.items():
+                attempts = stats['requests'] + stats['errors']
+                endpoints[endpoint] = {
+                    'requests': stats['requests'],
+                    'errors': stats['errors'],
+                    'retries': stats['retries'],
+                    'mean_ms': round(stats['total_ms'] / attempts, 2) if attempts else 0.0,
+                    'max_ms': round(stats['max_ms'], 2),
+                    'rate_limiter': self.limiters[endpoint].stats(),
+                    'circuit': self.breakers[endpoint].stats(),
+                }
+                if endpoint in self.hedgers:
+                    endpoints[endpoint]['hedging'] = self.hedgers[endpoint].stats()
+        # every request that did not open a new connection reused a keep-alive one
+        pools = self.session.get_adapter(self.urls['geocode']).poolmanager.pools
+        new_connections = sum(pools[key].num_connections for key in pools.keys())
+        total_requests = sum(pools[key].num_requests for key in pools.keys())
+        return {
+            'endpoints': endpoints,
+            'connections_opened': new_connections,
+            'connections_reused': max(total_requests - new_connections, 0),
+        }
@@ -0,0 +1,70 @@
+"""Background jobs for generating activities outside of the request."""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+# the '.' was added to support the website launch on render. For testing or if running the app locally, please comment out the next line and uncomment the following one.
+from .models import db, Job
+# from models import db, Job
+
+JOB_FAILED_MESSAGE = "The activities could not be added. Please try again."
+
+
+class JobQueue:
+    """A queue of background jobs stored in the Job table. Subclasses decide where the jobs run, so that a queue
+    backed by an outside service can replace the in-process default without changing the routes."""
+
+    def __init__(self, app, ttl=3600):
+        self.app = app
+        self.ttl = ttl
+
+    def submit(self, fn, user_id, total, *args):
+        """Saves a new Job, queues fn(job, *args) and returns the job"""
+        raise NotImplementedError
+
+    def get(self, job_id):
+        """Returns the job with the id, or None if it does not exist or has expired"""
+        job = db.session.get(Job, job_id)
+        if job is None or job.timestamp < datetime.utcnow() - timedelta(seconds=self.ttl):
+            return None
+        return job
+
+    def create(self, user_id, total):
+        """Saves and returns a new job, forgetting the jobs older than ttl"""
+        Job.query.filter(Job.timestamp < datetime.utcnow() - timedelta(seconds=self.ttl)).delete(synchronize_session=False)
+        job = Job(user_id=user_id, total=total)
+        db.session.add(job)
+        db.session.commit()
+        return job
+
+    def run(self, job_id, fn, *args):
+        """Runs the job, storing the value returned by fn as its result or the error it raised"""
+        # the job runs outside of the request, so it needs its own app context and database session
+        with self.app.app_context():
+            job = db.session.get(Job, job_id)
+            job.status = 'running'
+            db.session.commit()
+            try:
+                result = fn(job, *args)
+            except Exception:
+                # the error can contain SQL or request parameters, so it is only logged and the user gets a plain message
+                self.app.logger.exception("Job %s failed", job_id)
+                db.session.rollback()
+                job.error = JOB_FAILED_MESSAGE
+                job.status = 'failed'
+            else:
+                job.result = result
+                job.status = 'done'
+            db.session.commit()
+
+
+class ThreadJobQueue(JobQueue):
+    """Runs jobs on a pool of threads in this process."""
+
+    def __init__(self, app, max_workers=4, ttl=3600):
+        super().__init__(app, ttl)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='activity-job')
+
+    def submit(self, fn, user_id, total, *args):
+        job = self.create(user_id, total)
+        self.executor.submit(self.run, job.id, fn, *args)
+        return job
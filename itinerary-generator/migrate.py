@@ -0,0 +1,48 @@
+"""Brings an existing database up to date with the models without dropping any data."""
+from sqlalchemy import text, inspect
+
+from app import db, app
+
+# Columns added to existing tables after they were first created
+MIGRATIONS = [
+    "ALTER TABLE itineraries ADD COLUMN IF NOT EXISTS latitude FLOAT",
+    "ALTER TABLE itineraries ADD COLUMN IF NOT EXISTS longitude FLOAT",
+    "ALTER TABLE activities ADD COLUMN IF NOT EXISTS place_id VARCHAR",
+    "ALTER TABLE places ADD COLUMN IF NOT EXISTS url VARCHAR",
+    "ALTER TABLE places ADD COLUMN IF NOT EXISTS summary TEXT",
+    "ALTER TABLE places ADD COLUMN IF NOT EXISTS details_updated_at TIMESTAMP",
+    "ALTER TABLE places ALTER COLUMN latitude DROP NOT NULL",
+    "ALTER TABLE places ALTER COLUMN longitude DROP NOT NULL",
+    "ALTER TABLE places ALTER COLUMN geohash DROP NOT NULL",
+]
+
+# Moves the title, address, url and summary that every activity repeated into one places row per place.
+# Activities saved before place ids were stored share a made up place id if all three of their fields are the same.
+PLACE_MIGRATIONS = [
+    """UPDATE activities SET place_id = 'legacy:' || md5(concat_ws('|', title, address, activity_url))
+    WHERE place_id IS NULL""",
+    # the activity with details is preferred for each place, and the places already stored by searches keep their names
+    """INSERT INTO places (place_id, name, vicinity, url, summary, details_updated_at, updated_at)
+    SELECT DISTINCT ON (place_id) place_id, title, address, activity_url, summary,
+        CASE WHEN activity_url IS NOT NULL OR place_id LIKE 'legacy:%' THEN now() END, now()
+    FROM activities
+    ORDER BY place_id, activity_url IS NULL, id DESC
+    ON CONFLICT (place_id) DO UPDATE SET
+        url = COALESCE(places.url, EXCLUDED.url),
+        summary = COALESCE(places.summary, EXCLUDED.summary),
+        details_updated_at = COALESCE(places.details_updated_at, EXCLUDED.details_updated_at)""",
+    "ALTER TABLE activities ALTER COLUMN place_id SET NOT NULL",
+    "ALTER TABLE activities ADD CONSTRAINT activities_place_id_fkey FOREIGN KEY (place_id) REFERENCES places (place_id)",
+    "ALTER TABLE activities DROP COLUMN title, DROP COLUMN address, DROP COLUMN activity_url, DROP COLUMN summary",
+]
+
+app.app_context().push()
+# creates any new tables
+db.create_all()
+for statement in MIGRATIONS:
+    db.session.execute(text(statement))
+# the place data is only moved once, while the activities still have their own title
+if 'title' in [column['name'] for column in inspect(db.engine).get_columns('activities')]:
+    for statement in PLACE_MIGRATIONS:
+        db.session.execute(text(statement))
+db.session.commit()
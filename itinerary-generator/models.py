@@ -1,12 +1,18 @@
 """SQLAlchemy models for Spontinerary."""
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 from sqlalchemy.sql import func
+from sqlalchemy.orm import column_property
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from flask import flash
 
+# the '.' was added to support the website launch on render. For testing or if running the app locally, please comment out the next line and uncomment the following one.
+from .cache import geohash, geohash_cells, distance
+# from cache import geohash, geohash_cells, distance
+
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
@@ -67,6 +73,8 @@ class Itinerary(db.Model):
     timestamp = db.Column(db.DateTime, nullable=False, default=func.now())
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
     radius = db.Column(db.Integer, nullable=False)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
     notes = db.Column(db.Text)
     
     def __repr__(self):
@@ -88,15 +96,332 @@ class Activity(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     itinerary_id = db.Column(db.Integer, db.ForeignKey('itineraries.id', ondelete='CASCADE'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
-    title = db.Column(db.String, nullable=False)
     category = db.Column(db.String, nullable=False)
-    activity_url = db.Column(db.String)
-    address = db.Column(db.String)
-    summary = db.Column(db.Text)
+    # the place of the activity holds its title, address, url and summary, which are shared by every activity of the place
+    place_id = db.Column(db.String, db.ForeignKey('places.place_id'), nullable=False)
+    
+    # the place is loaded with the activity, since it is needed whenever the activity is shown
+    place = db.relationship('Place', lazy='joined')
     
     def __repr__(self):
         return f"Activity(id = {self.id}, ownerId = {self.user_id}, itineraryId = {self.itinerary_id})"
     
+    @property
+    def title(self):
+        """The name of the place"""
+        return self.place.name
+    
+    @property
+    def address(self):
+        """The address of the place"""
+        return self.place.vicinity
+    
+    @property
+    def activity_url(self):
+        """The Google Maps url of the place, once its details are loaded"""
+        return self.place.url
+    
+    @property
+    def summary(self):
+        """The summary of the place, once its details are loaded"""
+        return self.place.summary
+    
+    def to_dict(self):
+        """Returns the activity as a dictionary that can be sent as JSON"""
+        return {
+            'id': self.id,
+            'itinerary_id': self.itinerary_id,
+            'title': self.title,
+            'category': self.category,
+            'activity_url': self.activity_url,
+            'address': self.address,
+            'summary': self.summary,
+            'place_id': self.place_id,
+        }
+    
+
+# the number of activities of an itinerary is counted in the query that loads the itinerary, so that
+# listing itineraries with their counts does not load the activities of each one
+Itinerary.activity_count = column_property(
+    db.select(func.count(Activity.id)).where(Activity.itinerary_id == Itinerary.id).correlate_except(Activity).scalar_subquery()
+)
+
+
+class GeocodeCache(db.Model):
+    """The coordinates of a geocoded address, keyed on the normalized address."""
+
+    __tablename__ = 'geocode_cache'
+
+    address = db.Column(db.String, primary_key=True)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"GeocodeCache(address = {self.address}, latitude = {self.latitude}, longitude = {self.longitude})"
+
+    @classmethod
+    def lookup(cls, address, ttl):
+        """Returns the (latitude, longitude) of the address if it was stored less than ttl seconds ago, else None"""
+        entry = cls.query.get(address)
+        if entry and entry.timestamp > datetime.utcnow() - timedelta(seconds=ttl):
+            return entry.latitude, entry.longitude
+        return None
+
+    @classmethod
+    def store(cls, address, latitude, longitude, max_rows):
+        """Saves the coordinates of the address and deletes the oldest entries once there are more than max_rows"""
+        try:
+            db.session.merge(cls(address=address, latitude=latitude, longitude=longitude, timestamp=datetime.utcnow()))
+            db.session.flush()
+            
+            excess = cls.query.count() - max_rows
+            if excess > 0:
+                oldest = [address for (address,) in db.session.query(cls.address).order_by(cls.timestamp).limit(excess)]
+                cls.query.filter(cls.address.in_(oldest)).delete(synchronize_session=False)
+            db.session.commit()
+        except IntegrityError:
+            # another request stored the same address at the same time
+            db.session.rollback()
+
+
+class Place(db.Model):
+    """A place returned by a nearby search, kept so that later searches in the same area can be answered without Google.
+    Activities share the name, address and details of their place."""
+
+    __tablename__ = 'places'
+    # text_pattern_ops lets Postgres use the index for the prefix searches of nearby geohash cells
+    __table_args__ = (db.Index('ix_places_geohash', 'geohash', postgresql_ops={'geohash': 'text_pattern_ops'}),)
+
+    place_id = db.Column(db.String, primary_key=True)
+    name = db.Column(db.String, nullable=False)
+    vicinity = db.Column(db.String)
+    # the location is unknown for the places of activities saved before places were stored, so they are never found nearby
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    # the 9 character geohash of the location, whose prefixes are the cells containing it
+    geohash = db.Column(db.String(9))
+    rating = db.Column(db.Float)
+    user_ratings_total = db.Column(db.Integer)
+    types = db.Column(db.JSON)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # filled in from the place details when an activity of the place is first viewed
+    url = db.Column(db.String)
+    summary = db.Column(db.Text)
+    details_updated_at = db.Column(db.DateTime)
+
+    keywords = db.relationship('PlaceKeyword', backref='place', cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f"Place(place_id = {self.place_id}, name = {self.name}, geohash = {self.geohash})"
+
+    def to_result(self):
+        """Returns the place in the shape of a Google nearby search result"""
+        return {
+            'place_id': self.place_id,
+            'name': self.name,
+            'vicinity': self.vicinity,
+            'geometry': {'location': {'lat': self.latitude, 'lng': self.longitude}},
+            'rating': self.rating,
+            'user_ratings_total': self.user_ratings_total,
+            'types': self.types or [],
+        }
+
+    @property
+    def details_loaded(self):
+        """Whether the url and summary of the place are known"""
+        return self.details_updated_at is not None or self.url is not None
+
+    def set_details(self, details):
+        """Stores the url and summary from a Place Details result"""
+        self.url = details.get('url')
+        self.summary = details.get('editorial_summary', {}).get('overview')
+        self.details_updated_at = datetime.utcnow()
+
+    @classmethod
+    def get_or_add(cls, place_id, name, vicinity=None):
+        """Returns the stored place, adding it with the name and vicinity if its search could not save it"""
+        return db.session.get(cls, place_id) or cls.add(place_id, name, vicinity)
+
+    @classmethod
+    def add(cls, place_id, name, vicinity=None):
+        """Adds the place in a savepoint and returns it. If a search saved the same place since it was looked up,
+        the stored place is returned instead."""
+        try:
+            with db.session.begin_nested():
+                place = cls(place_id=place_id, name=name, vicinity=vicinity)
+                db.session.add(place)
+            return place
+        except IntegrityError:
+            place = db.session.get(cls, place_id)
+            if place is None:
+                raise
+            return place
+
+    @classmethod
+    def nearby(cls, location, radius, keyword, ttl):
+        """Returns the places within radius meters of the (latitude, longitude) location that were found by a search
+        for the keyword less than ttl seconds ago"""
+        cells = geohash_cells(location[0], location[1], radius)
+        candidates = (
+            cls.query.join(PlaceKeyword)
+            .filter(
+                PlaceKeyword.keyword == keyword.strip().lower(),
+                PlaceKeyword.timestamp > datetime.utcnow() - timedelta(seconds=ttl),
+                db.or_(*[cls.geohash.startswith(cell) for cell in cells])
+            )
+            .all()
+        )
+        # the cells cover a square around the circle, so the corners are filtered out here
+        return [place for place in candidates if distance(location, (place.latitude, place.longitude)) <= radius]
+
+    @classmethod
+    def harvest(cls, keyword, results):
+        """Saves the places of a nearby search response for the keyword, updating the ones that are already stored"""
+        keyword = keyword.strip().lower()
+        now = datetime.utcnow()
+        results = {result['place_id']: result for result in results}
+        try:
+            places = {place.place_id: place for place in cls.query.filter(cls.place_id.in_(results))}
+            found_by = {
+                place_keyword.place_id: place_keyword
+                for place_keyword in PlaceKeyword.query.filter(PlaceKeyword.place_id.in_(results), PlaceKeyword.keyword == keyword)
+            }
+            for place_id, result in results.items():
+                location = result['geometry']['location']
+                place = places.get(place_id) or cls(place_id=place_id)
+                place.name = result['name']
+                place.vicinity = result.get('vicinity')
+                place.latitude, place.longitude = location['lat'], location['lng']
+                place.geohash = geohash(location['lat'], location['lng'], 9)
+                place.rating = result.get('rating')
+                place.user_ratings_total = result.get('user_ratings_total')
+                place.types = result.get('types', [])
+                place.updated_at = now
+                db.session.add(place)
+                
+                place_keyword = found_by.get(place_id) or PlaceKeyword(place_id=place_id, keyword=keyword)
+                place_keyword.timestamp = now
+                db.session.add(place_keyword)
+            db.session.commit()
+        except IntegrityError:
+            # another request saved some of the same places at the same time
+            db.session.rollback()
+
+
+class PlaceKeyword(db.Model):
+    """A search keyword that a place was found by, and when it was last found by it."""
+
+    __tablename__ = 'place_keywords'
+    __table_args__ = (db.Index('ix_place_keywords_keyword_timestamp', 'keyword', 'timestamp'),)
+
+    place_id = db.Column(db.String, db.ForeignKey('places.place_id', ondelete='CASCADE'), primary_key=True)
+    keyword = db.Column(db.String, primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"PlaceKeyword(place_id = {self.place_id}, keyword = {self.keyword})"
+
+
+class IdempotencyKey(db.Model):
+    """The response to a request sent with an Idempotency-Key header, so that a retry of the request can be answered without repeating it.
+    The response is empty while the first request is still being processed."""
+
+    __tablename__ = 'idempotency_keys'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    key = db.Column(db.String(255), primary_key=True)
+    # a hash of the request, so that the key cannot be reused for a different request
+    request_hash = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer)
+    response = db.Column(db.JSON)
+    activity_ids = db.Column(db.JSON)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"IdempotencyKey(key = {self.key}, ownerId = {self.user_id}, status = {self.status_code})"
+
+    @classmethod
+    def claim(cls, user_id, key, request_hash, ttl, lease):
+        """Returns (entry, created). created is True if this request is the first with the key in the last ttl seconds and should be processed,
+        otherwise entry is the one stored by the first request. A request that has not responded within lease seconds is assumed to have
+        died, so a retry of it claims the key again."""
+        # keys older than ttl are forgotten
+        now = datetime.utcnow()
+        cls.query.filter(cls.timestamp < now - timedelta(seconds=ttl)).delete(synchronize_session=False)
+        db.session.commit()
+        
+        # only one retry can take over an expired lease, since the update checks the timestamp it replaces
+        taken_over = cls.query.filter(
+            cls.user_id == user_id, cls.key == key, cls.request_hash == request_hash,
+            cls.status_code.is_(None), cls.timestamp < now - timedelta(seconds=lease)
+        ).update({cls.timestamp: now}, synchronize_session=False)
+        db.session.commit()
+        
+        entry = cls.query.get((user_id, key))
+        if entry:
+            return entry, taken_over == 1
+        try:
+            entry = cls(user_id=user_id, key=key, request_hash=request_hash)
+            db.session.add(entry)
+            db.session.commit()
+            return entry, True
+        except IntegrityError:
+            # another request with the same key claimed it first
+            db.session.rollback()
+            return cls.query.get((user_id, key)), False
+
+    def complete(self, status_code, response, activity_ids=None):
+        """Stores the response of the request so that retries get it too"""
+        self.status_code = status_code
+        self.response = response
+        self.activity_ids = activity_ids or []
+        db.session.commit()
+
+    def release(self):
+        """Forgets the key of a request that failed, so that it can be retried"""
+        db.session.delete(self)
+        db.session.commit()
+
+
+class Job(db.Model):
+    """A unit of background work owned by a user, with its progress and result. Jobs are stored in the database,
+    so that any worker process can report on a job that another one is running."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    completed = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False)
+    # the activities saved so far and the error of each category that failed, so that they can be streamed while the job runs
+    activity_ids = db.Column(db.JSON, nullable=False, default=list)
+    failed = db.Column(db.JSON, nullable=False, default=dict)
+    result = db.Column(db.JSON)
+    error = db.Column(db.String)
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f"Job(id = {self.id}, ownerId = {self.user_id}, status = {self.status})"
+
+    def advance(self, steps=1):
+        """Marks steps of the job as completed and saves the progress so that it can be polled"""
+        self.completed += steps
+        db.session.commit()
+
+    def to_dict(self):
+        """Returns the status of the job as a dictionary that can be sent as JSON"""
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'completed': self.completed,
+            'total': self.total,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
 
 def connect_db(app):
     """Connect this db"""
@@ -0,0 +1,144 @@
+"""Strategies for picking activities from the places found for a category."""
+import math
+import random
+import threading
+
+# the '.' was added to support the website launch on render. For testing or if running the app locally, please comment out the next line and uncomment the following one.
+from .cache import TTLCache
+# from cache import TTLCache
+
+
+class AliasTable:
+    """Walker's alias method: after an O(n) setup, draws an index with probability proportional to its weight in O(1)."""
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = sum(weights)
+        # scale the weights so that they average 1, then pair every small one with a large one that tops it up
+        scaled = [weight * count / total for weight in weights] if total > 0 else [1.0] * count
+        self.probability = [1.0] * count
+        self.alias = list(range(count))
+        small = [i for i, weight in enumerate(scaled) if weight < 1]
+        large = [i for i, weight in enumerate(scaled) if weight >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.probability[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def __len__(self):
+        return len(self.probability)
+
+    def draw(self, rng):
+        """Returns a random index, picked with probability proportional to its weight"""
+        i = rng.randrange(len(self.probability))
+        return i if rng.random() < self.probability[i] else self.alias[i]
+
+
+def place_weights(places, prior_rating=3.0, prior_count=20):
+    """Returns the weight of each place from its rating and number of ratings. The rating is averaged with prior_count
+    ratings of prior_rating, so that a few good reviews count for less than many, and popular places get a boost."""
+    weights = []
+    for place in places:
+        count = place.get('user_ratings_total') or 0
+        rating = place.get('rating') or prior_rating
+        average = (rating * count + prior_rating * prior_count) / (count + prior_count)
+        weights.append(average * (1 + math.log10(1 + count)))
+    return weights
+
+
+class SelectionStrategy:
+    """Picks different places from the candidates of a category. Subclasses decide how likely each place is.
+    A seed makes the picks reproducible, e.g. for benchmarks."""
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+    def rng_for(self, key):
+        """Returns the random generator of the picks made for the key, e.g. a search. With a seed every key gets its own
+        generator, so picks made concurrently for different keys are the same whatever order they run in."""
+        if self.seed is None:
+            return self.rng
+        return random.Random(f"{self.seed}|{key}")
+
+    def select(self, places, count, exclude=(), rng=None):
+        """Returns up to count different places, leaving out the ones whose place_id is in exclude. The picks are drawn
+        from rng, or from the strategy's own generator if it is not given."""
+        raise NotImplementedError
+
+    def select_fresh(self, places, count, seen, exclude=(), rng=None):
+        """Returns up to count different places like select, preferring the ones whose place_id is not in seen.
+        Seen places are only picked once there are not enough others."""
+        picks = self.select(places, count, set(exclude) | seen, rng)
+        if len(picks) < count:
+            # every place that is neither seen nor excluded was picked, so the rest come from the seen ones
+            picked = {place['place_id'] for place in picks}
+            picks += self.select(places, count - len(picks), set(exclude) | picked, rng)
+        return picks
+
+
+class UniformSelection(SelectionStrategy):
+    """Picks every place with the same probability."""
+
+    def select(self, places, count, exclude=(), rng=None):
+        rng = rng or self.rng
+        candidates = [place for place in places if place['place_id'] not in exclude]
+        return rng.sample(candidates, min(count, len(candidates)))
+
+
+class WeightedSelection(SelectionStrategy):
+    """Picks places with probability proportional to place_weights. The alias table of each candidate list is kept,
+    so repeated picks from the same search results only cost a few random numbers each."""
+
+    def __init__(self, seed=None, prior_rating=3.0, prior_count=20, max_tables=2048):
+        super().__init__(seed)
+        self.prior_rating = prior_rating
+        self.prior_count = prior_count
+        self.tables = TTLCache(maxsize=max_tables, ttl=24 * 60 * 60)
+        self._lock = threading.Lock()
+
+    def alias_table(self, places):
+        """Returns the alias table of the places, building it the first time they are seen"""
+        key = tuple(place['place_id'] for place in places)
+        table = self.tables.get(key)
+        if table is None:
+            table = AliasTable(place_weights(places, self.prior_rating, self.prior_count))
+            self.tables.set(key, table)
+        return table
+
+    def select(self, places, count, exclude=(), rng=None):
+        rng = rng or self.rng
+        available = sum(1 for place in places if place['place_id'] not in exclude)
+        count = min(count, available)
+        if count == 0:
+            return []
+
+        # draw from the alias table until enough different places are found. Repeats and excluded places are drawn again.
+        table = self.alias_table(places)
+        chosen = {}
+        with self._lock:
+            for attempt in range(8 * (count + len(places))):
+                i = table.draw(rng)
+                if i not in chosen and places[i]['place_id'] not in exclude:
+                    chosen[i] = places[i]
+                    if len(chosen) == count:
+                        return list(chosen.values())
+
+            # most of the weight is on places that were already chosen or excluded, so the rest are
+            # picked without replacement with exponential keys (Efraimidis-Spirakis) instead
+            weights = place_weights(places, self.prior_rating, self.prior_count)
+            rest = [
+                (rng.random() ** (1 / weights[i]), i) for i in range(len(places))
+                if i not in chosen and places[i]['place_id'] not in exclude and weights[i] > 0
+            ]
+        for key, i in sorted(rest, reverse=True)[:count - len(chosen)]:
+            chosen[i] = places[i]
+        return list(chosen.values())
+
+
+SELECTION_STRATEGIES = {
+    'weighted': WeightedSelection,
+    'uniform': UniformSelection,
+}
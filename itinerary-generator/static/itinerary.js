@@ -14,14 +14,24 @@ ACTIVITY_CAT = [
 // comment out next line and uncomment following for unit testing
 const BASE_URL = "https://spontinerary.onrender.com";
 // const BASE_URL = "http://127.0.0.1:5000";
+// a background job is polled once a second for at most this many times
+const MAX_JOB_POLLS = 60;
 
 $(document).ready(function () {
   // Create an event listener on the Google picker to convert the user's input to the formatted address.
   $("gmpx-place-picker").on("gmpx-placechange", function (e) {
     let place = e.target.value;
     $("#location").val(place?.formattedAddress ?? "");
+    // Store the coordinates so that the server does not have to geocode the address again
+    $("#latitude").val(place?.location?.lat() ?? "");
+    $("#longitude").val(place?.location?.lng() ?? "");
   });
 
+  // Sent with the categories so that a double click or a retried request does not add the activities twice.
+  // A new key is made once the server responds, so that a page restored with the back button sends a new request
+  // instead of replaying the old response, and after a failure, since the user may then change the categories.
+  let idempotencyKey = crypto.randomUUID();
+
   //   Retrieves the user's selected category inputs and puts it into a list
   async function getCatInputs(e) {
     e.preventDefault();
@@ -38,19 +48,174 @@ $(document).ready(function () {
       }
     }
     try {
-      // Send the selected categories to the server via a POST request
+      // Send the selected categories to the server via a POST request. The server queues the work and
+      // responds with a job to follow instead of making us wait for every category.
       const resp = await axios.post(
         `${BASE_URL}/itinerary/${pathParts[2]}/new`,
-        { categories: selectedCats }
+        { categories: selectedCats },
+        { headers: { Prefer: "respond-async", "Idempotency-Key": idempotencyKey } }
       );
+      idempotencyKey = crypto.randomUUID();
+      // Browsers that support server-sent events go straight to the itinerary, which shows each activity of the job as it is found
+      if (resp.status === 202 && window.EventSource) {
+        window.location.href = `/itinerary/${pathParts[2]}?job=${resp.data.job_id}`;
+        return;
+      }
+      const redirectUrl =
+        resp.status === 202
+          ? await pollJob(resp.data.status_url)
+          : resp.data.redirect_url;
       // Redirect to the itinerary once it is added
-      window.location.href = resp.data.redirect_url;
+      window.location.href = redirectUrl;
     } catch (error) {
+      idempotencyKey = crypto.randomUUID();
       //Console error message if and error with selecting the errors occur
       console.error("Error submitting the selected categories:", error);
+      $("#activity-progress").text(
+        error.response?.data?.error ?? error.message ?? "The activities could not be added. Please try again."
+      );
     }
   }
 
+  // Polls the status of a background job until it is done and returns the url to redirect to
+  async function pollJob(statusUrl) {
+    const $progress = $("#activity-progress");
+    for (let attempt = 0; attempt < MAX_JOB_POLLS; attempt++) {
+      const resp = await axios.get(`${BASE_URL}${statusUrl}`);
+      const job = resp.data;
+      if (job.status === "done") {
+        return job.result.redirect_url;
+      }
+      if (job.status === "failed") {
+        throw new Error(job.error);
+      }
+      $progress.text(`Finding activities... (${job.completed}/${job.total})`);
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+    throw new Error("Finding activities is taking longer than expected. Please check the itinerary again later.");
+  }
+
+  // Follows the job adding activities to the itinerary and renders each one as soon as it is saved
+  function streamActivities() {
+    const jobId = new URLSearchParams(window.location.search).get("job");
+    if (!jobId || !$("#activities-box").length) {
+      return;
+    }
+
+    const $progress = $("<p>", {
+      class: "text-muted",
+      id: "activity-progress",
+      text: "Finding activities...",
+    });
+    $("#activities-box").append($progress);
+
+    const source = new EventSource(`${BASE_URL}/jobs/${jobId}/events`);
+    source.addEventListener("activity", (e) =>
+      renderActivity(JSON.parse(e.data))
+    );
+    source.addEventListener("failed", (e) =>
+      console.error("Error adding activities:", JSON.parse(e.data).error)
+    );
+    source.addEventListener("done", (e) => {
+      source.close();
+      // categories that ran out of time or failed are listed so that the user can add them again
+      const data = JSON.parse(e.data);
+      if (data.error) {
+        $progress.text(data.error);
+        return;
+      }
+      const missing = [...(data.skipped || []), ...Object.keys(data.failed || {})];
+      const empty = data.empty || [];
+      if (missing.length || empty.length) {
+        $progress.text(
+          [
+            missing.length ? `No activities could be added for: ${missing.join(", ")}.` : "",
+            empty.length ? `Nothing nearby was found for: ${empty.join(", ")}.` : "",
+          ].join(" ")
+        );
+      } else {
+        $progress.remove();
+      }
+    });
+    // close the connection on errors, otherwise the browser keeps reconnecting
+    source.onerror = () => {
+      source.close();
+      $progress.text("Could not add all of the activities.");
+    };
+  }
+
+  // Adds an activity to the list of activities on the itinerary page, unless the page already showed it when it loaded
+  function renderActivity(activity) {
+    if ($(`#activities [data-activity-id="${activity.id}"]`).length) {
+      return;
+    }
+    let $list = $("#activities");
+    if (!$list.length) {
+      $("#no-activities").remove();
+      $list = $("<ul>", { class: "list-group", id: "activities" });
+      $("#activity-progress").before($list);
+    }
+
+    const $info = $("<div>", { class: "itinerary-info" })
+      .append(
+        $("<a>", {
+          href: activity.activity_url,
+          class: "activity-title",
+          text: activity.title,
+        })
+      )
+      .append(
+        $("<p>").append(
+          activity.summary ? $("<i>", { text: activity.summary }) : ""
+        )
+      )
+      .append(
+        $("<p>", {
+          class: "single-itineraries",
+          text: `Location: ${activity.address}`,
+        })
+      )
+      .append(
+        $("<small>").append(
+          $("<p>", {
+            class: "single-itineraries",
+            text: `Category: ${activity.category}`,
+          })
+        )
+      );
+
+    const $delete = $("<div>", { class: "d-flex" })
+      .append(
+        $("<form>", {
+          action: `/activity/${activity.id}/reroll`,
+          method: "POST",
+        }).append(
+          $("<button>", {
+            class: "btn btn-secondary",
+            title: "Replace with another activity",
+          }).append($("<i>", { class: "fas fa-sync-alt" }))
+        )
+      )
+      .append(
+        $("<form>", {
+          action: `/activity/${activity.id}/delete`,
+          method: "POST",
+        }).append($("<button>", { class: "btn btn-danger", text: "X" }))
+      );
+
+    $list.append(
+      $("<li>", {
+        class:
+          "list-group-item d-flex justify-content-between align-items-center",
+        "data-activity-id": activity.id,
+      })
+        .append($info)
+        .append($delete)
+    );
+  }
+
+  streamActivities();
+
   // Renders the activity input fields depending on the the count chosen in the add activities page
   function renderActivityInputs(count) {
     const $activityInputContainer = $("#activity-input-container");
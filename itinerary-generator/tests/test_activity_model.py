@@ -7,7 +7,7 @@ from unittest import TestCase
 from sqlalchemy import exc
 
 
-from models import db, User, Activity, Itinerary
+from models import db, User, Activity, Itinerary, Place
 
 os.environ['DATABASE_URL'] = "postgresql:///spontinerary-test"
 
@@ -78,20 +78,14 @@ class ActivityModelTestCase(TestCase):
         # create activities to add to the itineraries
         a1 = Activity(
             user_id = self.user_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
         
         a2 = Activity(
             user_id = self.user_id,
-            title = "Some activity",
             category = "outdoor",
-            activity_url = "test.com",
-            address = "345 imaginary st",
-            summary = "summary2"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary2")
         )
         
         self.i1.add_activities([a1,a2])
@@ -120,10 +114,8 @@ class ActivityModelTestCase(TestCase):
         activity = Activity(
             itinerary_id=self.i1_id,
             user_id=self.user_id,
-            title='Another test',
             category='Tours',
-            activity_url=None,
-            address=None    
+            place=Place(place_id="another-test", name='Another test')
         )
         db.session.add(activity)
         db.session.commit()
@@ -135,8 +127,7 @@ class ActivityModelTestCase(TestCase):
             itinerary_id=self.i1_id,
             user_id=self.user_id,
             category='Tours',
-            activity_url=None,
-            address=None    
+            place=Place(place_id="no-name")
         )
         activity.id = 3457
         db.session.add(activity)
@@ -148,10 +139,7 @@ class ActivityModelTestCase(TestCase):
         activity = Activity(
             itinerary_id=self.i1_id,
             user_id = self.user_id,
-            title = "Some activity",
-            activity_url = "test.com",
-            address = "345 imaginary st",
-            summary = "summary"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary")
         )
         activity.id = 3457
         db.session.add(activity)
@@ -162,11 +150,8 @@ class ActivityModelTestCase(TestCase):
         """Tests that the activity raises an exception when the itinerary is not added."""
         activity = Activity(
             user_id = self.user_id,
-            title = "Some activity",
-            activity_url = "test.com",
             category = "tour",
-            address = "345 imaginary st",
-            summary = "summary"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary")
         )
         activity.id = 66
         db.session.add(activity)
@@ -178,11 +163,8 @@ class ActivityModelTestCase(TestCase):
         activity = Activity(
             itinerary_id = 829357498575,
             user_id = self.user_id,
-            title = "Some activity",
-            activity_url = "test.com",
             category = "tour",
-            address = "345 imaginary st",
-            summary = "summary"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary")
         )
         activity.id = 9
         db.session.add(activity)
@@ -193,11 +175,8 @@ class ActivityModelTestCase(TestCase):
         """Tests that the activity raises an exception when the user id is not added."""
         activity = Activity(
             itinerary_id=self.i1_id,
-            title = "Some activity",
-            activity_url = "test.com",
             category = "tour",
-            address = "345 imaginary st",
-            summary = "summary"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary")
         )
         activity.id = 66
         db.session.add(activity)
@@ -209,11 +188,8 @@ class ActivityModelTestCase(TestCase):
         activity = Activity(
             itinerary_id = self.i1_id,
             user_id = 856845967,
-            title = "Some activity",
-            activity_url = "test.com",
             category = "tour",
-            address = "345 imaginary st",
-            summary = "summary"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary")
         )
         activity.id = 82
         db.session.add(activity)
@@ -226,11 +202,8 @@ class ActivityModelTestCase(TestCase):
         activity = Activity(
             itinerary_id = self.i1_id,
             user_id = self.user_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
         db.session.add(activity)
         db.session.commit()
@@ -4,24 +4,48 @@
 
 
 import os
+import json
+import time
+import hashlib
+from datetime import datetime, timedelta
 from unittest import TestCase
-from unittest.mock import patch
-import requests
+from unittest.mock import patch, MagicMock
 
-from models import db, connect_db, User, Activity, Itinerary
-from app import get_long_lat, process_activities
+from models import db, connect_db, User, Activity, Itinerary, GeocodeCache, IdempotencyKey, Place, Job
+from app import get_long_lat, get_place_details, nearby_search, process_activities, save_activity, run_details_prefetch, maps_client, job_queue, geocode_cache, nearby_cache, details_cache, seen_places
+from google_maps import DEFAULT_TIMEOUTS
+from sampling import WeightedSelection
 GOOGLE_MAPS_API_KEY = os.getenv('GOOGLE_MAPS_API_KEY')
 
 
 os.environ['DATABASE_URL'] = "postgresql:///spontinerary-test"
 
 
+def mock_google_get(url, params=None, **kwargs):
+    """Returns a fake Google Maps response based on the url that was requested"""
+    resp = MagicMock()
+    resp.status_code = 200
+    if 'geocode' in url:
+        resp.json.return_value = {'status': 'OK', 'results': [{'geometry': {'location': {'lat': 41.892654, 'lng': -87.610168}}}]}
+    elif 'nearbysearch' in url:
+        keyword = params['keyword']
+        resp.json.return_value = {'status': 'OK', 'results': [
+            {'place_id': f"{keyword}-id-{i}", 'name': f"{keyword} place {i}", 'vicinity': f"{i} {keyword} st",
+             'geometry': {'location': {'lat': 41.892654 + i * 0.00001, 'lng': -87.610168}}} for i in range(3)
+        ]}
+    else:
+        resp.json.return_value = {'status': 'OK', 'result': {'url': f"https://maps.google.com/?cid={params['place_id']}", 'editorial_summary': {'overview': 'A summary'}}}
+    return resp
+
+
 from app import app, CURR_USER_KEY
 app.app_context().push()
 
 db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
+# the place details are loaded by the tests instead of in the background
+app.config['PREFETCH_PLACE_DETAILS'] = False
 
 
 class ActivityViewTestCase(TestCase):
@@ -31,6 +55,12 @@ class ActivityViewTestCase(TestCase):
         """Create test client, add sample data."""
         db.drop_all()
         db.create_all()
+        geocode_cache.clear()
+        nearby_cache.clear()
+        details_cache.clear()
+        seen_places.clear()
+        for breaker in maps_client.breakers.values():
+            breaker.reset()
 
         self.client = app.test_client()
       
@@ -67,9 +97,11 @@ class ActivityViewTestCase(TestCase):
         """Clean up any fouled transactions"""
         res = super().tearDown()
         db.session.rollback()
+        # forget this test's objects, since the next test's rows reuse their ids
+        db.session.expunge_all()
         return res
     
-    @patch('app.requests.get')
+    @patch.object(maps_client.session, 'get')
     def test_get_long_lat(self, mock_get):
         """Tests get_long_lat successffully returns the longitude and latitude"""
         # create a mock resp data
@@ -97,10 +129,26 @@ class ActivityViewTestCase(TestCase):
         # Assert that the request was made with the correct URL and parameters
         mock_get.assert_called_once_with(
             "https://maps.googleapis.com/maps/api/geocode/json",
-            params={'address': "600 E Grand Ave, Chicago, IL", 'key': GOOGLE_MAPS_API_KEY}
+            params={'address': "600 E Grand Ave, Chicago, IL", 'key': GOOGLE_MAPS_API_KEY},
+            timeout=DEFAULT_TIMEOUTS['geocode']
         )
         
-    @patch('app.requests.get')
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_get_long_lat_cached(self, mock_get):
+        """Tests that repeated geocodes of the same address are served from the cache"""
+        first = get_long_lat("600 E Grand Ave, Chicago, IL")
+        second = get_long_lat("600 e grand ave  chicago IL")
+        
+        self.assertEqual(first, second)
+        self.assertEqual(mock_get.call_count, 1)
+        
+        # the persistent cache is used when the in-memory cache is empty
+        geocode_cache.clear()
+        self.assertIsNotNone(GeocodeCache.query.get("600 e grand ave chicago il"))
+        self.assertEqual(get_long_lat("600 E Grand Ave, Chicago, IL"), first)
+        self.assertEqual(mock_get.call_count, 1)
+        
+    @patch.object(maps_client.session, 'get')
     def test_unsuccessful_get_long_lat(self, mock_get):
         """Test that get_long_lat raises an exception when the API call fails."""
 
@@ -118,13 +166,55 @@ class ActivityViewTestCase(TestCase):
             get_long_lat("3856374 fake address")
 
         self.assertIn("Error getting geocode: ZERO_RESULTS", str(context.exception))
+        
+        # the address is remembered as not found, so asking again does not call the API
+        with self.assertRaises(Exception) as context:
+            get_long_lat("3856374 Fake Address")
+        self.assertIn("Error getting geocode: ZERO_RESULTS", str(context.exception))
 
         # Assert that the request was made with the correct URL and parameters
         mock_get.assert_called_once_with(
             "https://maps.googleapis.com/maps/api/geocode/json",
-            params={'address': "3856374 fake address", 'key': GOOGLE_MAPS_API_KEY}
+            params={'address': "3856374 fake address", 'key': GOOGLE_MAPS_API_KEY},
+            timeout=DEFAULT_TIMEOUTS['geocode']
         )
     
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_get_place_details(self, mock_get):
+        """Tests that place details only request the stored fields and are cached by place_id"""
+        details = get_place_details("some-place-id")
+        self.assertEqual(details['editorial_summary']['overview'], "A summary")
+        self.assertEqual(get_place_details("some-place-id"), details)
+        
+        mock_get.assert_called_once_with(
+            "https://maps.googleapis.com/maps/api/place/details/json",
+            params={'place_id': "some-place-id", 'fields': "url,editorial_summary", 'key': GOOGLE_MAPS_API_KEY},
+            timeout=DEFAULT_TIMEOUTS['details']
+        )
+        
+    @patch.object(maps_client, 'circuit_state', return_value='open')
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_nearby_search_stale_while_open(self, mock_get, mock_state):
+        """Tests that expired nearby search results are served without a request while the circuit is open"""
+        location = (41.892654, -87.610168)
+        places = [{'place_id': "old-id", 'name': "Old place", 'vicinity': "1 Old st", 'geometry': {'location': {'lat': 41.892654, 'lng': -87.610168}}}]
+        key = ('dp3wq6', 1000, 'food')
+        nearby_cache.set(key, places, ttl=-1)
+        
+        self.assertEqual(nearby_search(location, 20, "Food"), places)
+        mock_get.assert_not_called()
+        
+    @patch('app.revalidator.submit')
+    @patch.object(maps_client, 'circuit_state', return_value='half_open')
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_place_details_revalidated_when_half_open(self, mock_get, mock_state, mock_submit):
+        """Tests that expired details are served and refreshed in the background once the circuit half-opens"""
+        details_cache.set("old-id", {'url': "old.com"}, ttl=-1)
+        
+        self.assertEqual(get_place_details("old-id"), {'url': "old.com"})
+        mock_get.assert_not_called()
+        mock_submit.assert_called_once()
+        
     def test_add_activities(self):
         """Tests that the activities are successfully added with the given categories"""
         with self.client as client:
@@ -149,6 +239,500 @@ class ActivityViewTestCase(TestCase):
             self.assertEqual(len(user1_activities), 2)
             self.assertEqual(len(i1_activities), 2)
         
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_process_activities(self, mock_get):
+        """Tests that process_activities adds one activity per category in the order they were given"""
+        categories = ['Food', 'Tours', 'Music', 'Hiking']
+        process_activities(self.i1, categories)
+
+        activities = Activity.query.filter_by(itinerary_id=self.i1_id).order_by(Activity.id).all()
+        self.assertEqual([a.category for a in activities], categories)
+        self.assertIn(activities[0].title, ["Food place 0", "Food place 1", "Food place 2"])
+        self.assertEqual(activities[0].address, f"{activities[0].title[-1]} Food st")
+        self.assertEqual(activities[0].place_id, f"Food-id-{activities[0].title[-1]}")
+        
+        # the place details are not requested while generating
+        details_calls = [c for c in mock_get.call_args_list if 'details' in c.args[0]]
+        self.assertEqual(len(details_calls), 0)
+        self.assertIsNone(activities[0].summary)
+        
+        # the itinerary location is geocoded once and stored
+        geocode_calls = [c for c in mock_get.call_args_list if 'geocode' in c.args[0]]
+        self.assertEqual(len(geocode_calls), 1)
+        self.assertEqual(self.i1.latitude, 41.892654)
+        self.assertEqual(self.i1.longitude, -87.610168)
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_place_details_loaded_on_view(self, mock_get):
+        """Tests that the place details of new activities are requested together the first time the itinerary is shown"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        process_activities(self.i1, ['Food', 'Tours', 'Music'])
+        
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            response = client.get(f'/itinerary/{self.i1_id}')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("A summary", response.get_data(as_text=True))
+            
+            # the details are saved, so showing the itinerary again does not request them
+            client.get(f'/itinerary/{self.i1_id}')
+        
+        details_calls = [c for c in mock_get.call_args_list if 'details' in c.args[0]]
+        self.assertEqual(len(details_calls), 3)
+        for activity in Activity.query.filter_by(itinerary_id=self.i1_id):
+            self.assertEqual(activity.activity_url, f"https://maps.google.com/?cid={activity.place_id}")
+            self.assertEqual(activity.summary, "A summary")
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_place_details_prefetch(self, mock_get):
+        """Tests that the prefetcher loads the place details of the activities"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        result = process_activities(self.i1, ['Food'])
+        
+        run_details_prefetch(result['activity_ids'])
+        
+        activity = Activity.query.get(result['activity_ids'][0])
+        db.session.refresh(activity)
+        self.assertEqual(activity.summary, "A summary")
+
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_place_details_shared(self, mock_get):
+        """Tests that activities of the same place share one places row and its details are requested once"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        i2 = Itinerary(title="second itinerary", location="600 E Grand Ave, Chicago, IL", latitude=41.892654, longitude=-87.610168,
+                       user_id=self.user1_id, radius=20)
+        db.session.add(i2)
+        db.session.commit()
+        process_activities(self.i1, ['Food', 'Food', 'Food'])
+        process_activities(i2, ['Food', 'Food', 'Food'])
+        details_cache.clear()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            c.get(f"/itinerary/{self.i1_id}")
+            resp = c.get(f"/itinerary/{i2.id}")
+            self.assertIn("A summary", resp.get_data(as_text=True))
+
+        details_calls = [c for c in mock_get.call_args_list if 'details' in c.args[0]]
+        self.assertEqual(len(details_calls), 3)
+        self.assertEqual(Place.query.count(), 3)
+        self.assertEqual(Activity.query.count(), 6)
+
+    def test_place_details_not_found(self):
+        """Tests that a place Google no longer knows is marked as loaded, while a failed details request is tried again"""
+        for place_id in ("obsolete", "flaky"):
+            db.session.add(Activity(itinerary_id=self.i1_id, user_id=self.user1_id, category="Food", place=Place(place_id=place_id, name=place_id)))
+        db.session.commit()
+
+        def details_get(url, params=None, **kwargs):
+            resp = mock_google_get(url, params, **kwargs)
+            status = 'NOT_FOUND' if params['place_id'] == "obsolete" else 'UNKNOWN_ERROR'
+            resp.json.return_value = {'status': status}
+            return resp
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            with patch.object(maps_client.session, 'get', side_effect=details_get) as mock_get:
+                for i in range(3):
+                    self.assertEqual(c.get(f"/itinerary/{self.i1_id}").status_code, 200)
+
+        requested = [call.kwargs['params']['place_id'] for call in mock_get.call_args_list]
+        self.assertEqual(requested.count("obsolete"), 1)
+        self.assertGreater(requested.count("flaky"), 1)
+        self.assertTrue(Place.query.get("obsolete").details_loaded)
+        self.assertIsNone(Place.query.get("obsolete").url)
+        self.assertFalse(Place.query.get("flaky").details_loaded)
+
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_process_activities_stored_coordinates(self, mock_get):
+        """Tests that process_activities does not geocode an itinerary that has coordinates"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        
+        process_activities(self.i1, ['Food', 'Tours'])
+        
+        geocode_calls = [c for c in mock_get.call_args_list if 'geocode' in c.args[0]]
+        self.assertEqual(len(geocode_calls), 0)
+        self.assertEqual(len(Activity.query.filter_by(itinerary_id=self.i1_id).all()), 2)
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_process_activities_repeated_category(self, mock_get):
+        """Tests that a category chosen several times is searched once and gives distinct places"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        
+        process_activities(self.i1, ['Food', 'Tours', 'Food', 'Food'])
+        
+        search_calls = [c for c in mock_get.call_args_list if 'nearbysearch' in c.args[0]]
+        self.assertEqual(len(search_calls), 2)
+        
+        activities = Activity.query.filter_by(itinerary_id=self.i1_id).order_by(Activity.id).all()
+        self.assertEqual([a.category for a in activities], ['Food', 'Tours', 'Food', 'Food'])
+        food_titles = {a.title for a in activities if a.category == 'Food'}
+        self.assertEqual(food_titles, {"Food place 0", "Food place 1", "Food place 2"})
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_process_activities_cached_search(self, mock_get):
+        """Tests that later generations in the same area reuse the cached nearby search results"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        
+        process_activities(self.i1, ['Food'])
+        process_activities(self.i1, ['Food'])
+        
+        search_calls = [c for c in mock_get.call_args_list if 'nearbysearch' in c.args[0]]
+        self.assertEqual(len(search_calls), 1)
+        self.assertEqual(len(Activity.query.filter_by(itinerary_id=self.i1_id).all()), 2)
+        
+    def test_process_activities_deadline(self):
+        """Tests that the categories that are not searched before the deadline are skipped and the rest are added"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        
+        def slow_music_get(url, params=None, **kwargs):
+            # the Music search takes longer than the whole deadline
+            if 'nearbysearch' in url and params['keyword'] == 'Music':
+                time.sleep(0.5)
+            return mock_google_get(url, params, **kwargs)
+        
+        with patch.object(maps_client.session, 'get', side_effect=slow_music_get), \
+                patch.dict(app.config, {'ACTIVITY_DEADLINE': 0.2}):
+            start = time.monotonic()
+            result = process_activities(self.i1, ['Food', 'Music', 'Tours'])
+            elapsed = time.monotonic() - start
+        
+        self.assertEqual(result['skipped'], ['Music'])
+        self.assertEqual(result['failed'], {})
+        self.assertLess(elapsed, 0.45)
+        activities = Activity.query.filter_by(itinerary_id=self.i1_id).order_by(Activity.id).all()
+        self.assertEqual([a.category for a in activities], ['Food', 'Tours'])
+        
+        # let the abandoned Music search finish so that it does not fill the caches of the next test
+        time.sleep(0.5)
+        
+    def test_process_activities_failed_category(self):
+        """Tests that the categories that succeeded are saved when others fail and that the failures are reported"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        
+        def failing_get(url, params=None, **kwargs):
+            resp = mock_google_get(url, params, **kwargs)
+            if 'nearbysearch' in url and params['keyword'] == 'Music':
+                # the Music search fails
+                resp.status_code = 400
+            elif 'nearbysearch' in url and params['keyword'] == 'Tours':
+                # a Tours place without a name cannot be inserted
+                for place in resp.json.return_value['results']:
+                    place['name'] = None
+            return resp
+        
+        with patch.object(maps_client.session, 'get', side_effect=failing_get):
+            result = process_activities(self.i1, ['Food', 'Music', 'Tours', 'Hiking'])
+        
+        self.assertEqual(result['skipped'], [])
+        self.assertEqual(sorted(result['failed']), ['Music', 'Tours'])
+        # the errors are logged, and the user only gets a message that does not show the request or the SQL
+        self.assertEqual(result['failed']['Music'], "The Music activities could not be added. Please try again.")
+        self.assertEqual(result['failed']['Tours'], "The Tours activities could not be added. Please try again.")
+        activities = Activity.query.filter_by(itinerary_id=self.i1_id).order_by(Activity.id).all()
+        self.assertEqual([a.category for a in activities], ['Food', 'Hiking'])
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_add_activities_idempotent(self, mock_get):
+        """Tests that a retry with the same Idempotency-Key gets the first response without adding activities again"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            headers = {'Idempotency-Key': "key-1"}
+            first = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food', 'Tours']}, headers=headers)
+            calls = mock_get.call_count
+            retry = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food', 'Tours']}, headers=headers)
+            
+            self.assertEqual(first.status_code, 200)
+            self.assertEqual(retry.status_code, 200)
+            self.assertEqual(retry.json, first.json)
+            self.assertEqual(retry.headers['Idempotent-Replayed'], "true")
+            self.assertEqual(mock_get.call_count, calls)
+            
+            activity_ids = [a.id for a in Activity.query.filter_by(itinerary_id=self.i1_id).order_by(Activity.id)]
+            self.assertEqual(first.json['activity_ids'], activity_ids)
+            self.assertEqual(IdempotencyKey.query.get((self.user1_id, "key-1")).activity_ids, activity_ids)
+            
+            # the key cannot be reused for other categories
+            other = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Music']}, headers=headers)
+            self.assertEqual(other.status_code, 422)
+            self.assertEqual(len(activity_ids), 2)
+            
+    def test_add_activities_idempotent_in_progress(self):
+        """Tests that a retry sent while the first request is still being processed is rejected"""
+        # the first request claimed the key but has not stored its response yet
+        request_hash = hashlib.sha256(json.dumps([self.i1_id, ['Food'], False]).encode('utf-8')).hexdigest()
+        IdempotencyKey.claim(self.user1_id, "key-1", request_hash, 60, 60)
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            response = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food']}, headers={'Idempotency-Key': "key-1"})
+            
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(response.headers['Retry-After'], "1")
+            self.assertEqual(Activity.query.filter_by(itinerary_id=self.i1_id).count(), 0)
+            
+    def test_add_activities_idempotency_key_too_long(self):
+        """Tests that an Idempotency-Key too long to be stored is rejected"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            response = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food']}, headers={'Idempotency-Key': "k" * 256})
+            
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(IdempotencyKey.query.count(), 0)
+            self.assertEqual(Activity.query.filter_by(itinerary_id=self.i1_id).count(), 0)
+            
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_add_activities_idempotent_expired_lease(self, mock_get):
+        """Tests that a retry takes over the key of a first request that died before it responded"""
+        request_hash = hashlib.sha256(json.dumps([self.i1_id, ['Food'], False]).encode('utf-8')).hexdigest()
+        entry, created = IdempotencyKey.claim(self.user1_id, "key-1", request_hash, 60, 60)
+        entry.timestamp = datetime.utcnow() - timedelta(seconds=120)
+        db.session.commit()
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            response = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food']}, headers={'Idempotency-Key': "key-1"})
+            
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(Activity.query.filter_by(itinerary_id=self.i1_id).count(), 1)
+            
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_add_activities_async_idempotent(self, mock_get):
+        """Tests that a double submit of the form with the same Idempotency-Key starts one job"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            headers = {'Prefer': 'respond-async', 'Idempotency-Key': "key-1"}
+            first = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food']}, headers=headers)
+            retry = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food']}, headers=headers)
+            
+            self.assertEqual(first.status_code, 202)
+            self.assertEqual(retry.status_code, 202)
+            self.assertEqual(retry.json['job_id'], first.json['job_id'])
+            self.assertEqual(Job.query.count(), 1)
+            
+            # the stream waits for the job to finish
+            client.get(first.json['events_url']).get_data()
+            self.assertEqual(Activity.query.filter_by(itinerary_id=self.i1_id).count(), 1)
+            
+    def test_process_activities_empty_category(self):
+        """Tests that a category with no places nearby is reported and its empty search is cached"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        
+        def empty_music_get(url, params=None, **kwargs):
+            resp = mock_google_get(url, params, **kwargs)
+            if 'nearbysearch' in url and params['keyword'] == 'Music':
+                resp.json.return_value = {'status': 'ZERO_RESULTS', 'results': []}
+            return resp
+        
+        with patch.object(maps_client.session, 'get', side_effect=empty_music_get) as mock_get:
+            result = process_activities(self.i1, ['Food', 'Music'])
+            process_activities(self.i1, ['Music'])
+        
+        self.assertEqual(result['empty'], ['Music'])
+        self.assertEqual(result['failed'], {})
+        music_searches = [c for c in mock_get.call_args_list if 'nearbysearch' in c.args[0] and c.kwargs['params']['keyword'] == 'Music']
+        self.assertEqual(len(music_searches), 1)
+        self.assertEqual([a.category for a in Activity.query.filter_by(itinerary_id=self.i1_id)], ['Food'])
+
+    def test_process_activities_refused_category(self):
+        """Tests that a search Google refused is reported as failed rather than empty, and is not cached"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+
+        def denied_music_get(url, params=None, **kwargs):
+            resp = mock_google_get(url, params, **kwargs)
+            if 'nearbysearch' in url and params['keyword'] == 'Music':
+                resp.json.return_value = {'status': 'REQUEST_DENIED', 'results': []}
+            return resp
+
+        with patch.object(maps_client.session, 'get', side_effect=denied_music_get):
+            result = process_activities(self.i1, ['Food', 'Music'])
+
+        self.assertEqual(result['empty'], [])
+        self.assertEqual(list(result['failed']), ['Music'])
+        self.assertEqual(nearby_cache.stats()['size'], 1)
+
+    def test_add_activities_refused(self):
+        """Tests that the request fails with a 503 when Google refuses every search"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+
+        def throttled_get(url, params=None, **kwargs):
+            resp = mock_google_get(url, params, **kwargs)
+            resp.json.return_value = {'status': 'OVER_QUERY_LIMIT', 'results': []}
+            return resp
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            with patch.object(maps_client.session, 'get', side_effect=throttled_get):
+                resp = client.post(f'/itinerary/{self.i1_id}/new', json={'categories': ['Food', 'Music']})
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(Activity.query.filter_by(itinerary_id=self.i1_id).count(), 0)
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_process_activities_place_index(self, mock_get):
+        """Tests that the places found by a search are saved and later generations nearby are picked from them without Google"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        self.i1.radius = 5000
+        db.session.commit()
+        
+        with patch.dict(app.config, {'PLACE_INDEX_MIN_CANDIDATES': 3}):
+            process_activities(self.i1, ['Food'])
+            self.assertEqual(Place.query.count(), 3)
+            self.assertEqual(Place.query.get("Food-id-1").keywords[0].keyword, "food")
+            
+            # a nearby itinerary in another cache cell is answered from the places table
+            nearby_cache.clear()
+            self.i1.latitude = 41.9
+            db.session.commit()
+            process_activities(self.i1, ['Food', 'Food'])
+        
+        search_calls = [c for c in mock_get.call_args_list if 'nearbysearch' in c.args[0]]
+        self.assertEqual(len(search_calls), 1)
+        activities = Activity.query.filter_by(itinerary_id=self.i1_id).order_by(Activity.id).all()
+        self.assertEqual(len(activities), 3)
+        self.assertEqual(len({a.title for a in activities[1:]}), 2)
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_add_activities_async(self, mock_get):
+        """Tests that the activities are added by a background job when the client prefers an async response"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            response = client.post(
+                f'/itinerary/{self.i1_id}/new',
+                json={'categories': ['Food', 'Tours', 'Food']},
+                headers={'Prefer': 'respond-async'}
+            )
+            self.assertEqual(response.status_code, 202)
+            job_id = response.json['job_id']
+            self.assertEqual(response.json['status_url'], f"/jobs/{job_id}")
+            
+            # poll the job until it is done
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                status = client.get(f"/jobs/{job_id}").json
+                if status['status'] not in ('queued', 'running'):
+                    break
+                time.sleep(0.05)
+            
+            self.assertEqual(status['status'], 'done')
+            self.assertEqual(status['completed'], 2)
+            self.assertEqual(status['total'], 2)
+            self.assertEqual(status['result']['redirect_url'], f"/itinerary/{self.i1_id}")
+            self.assertEqual(status['result']['skipped'], [])
+            self.assertEqual(status['result']['failed'], {})
+            self.assertEqual(len(Activity.query.filter_by(itinerary_id=self.i1_id).all()), 3)
+            
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_stream_job_events(self, mock_get):
+        """Tests that each activity saved by a job is sent as a server-sent event, and that following the job again adds nothing"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+
+            response = client.post(
+                f'/itinerary/{self.i1_id}/new',
+                json={'categories': ['Food', 'Tours', 'Food']},
+                headers={'Prefer': 'respond-async'}
+            )
+            self.assertEqual(response.status_code, 202)
+            job_id = response.json['job_id']
+            self.assertEqual(response.json['events_url'], f"/jobs/{job_id}/events")
+            
+            response = client.get(f"/jobs/{job_id}/events")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            
+            # split the stream into (event, data) pairs
+            events = []
+            for message in response.get_data(as_text=True).strip().split("\n\n"):
+                event, data = message.split("\n")
+                events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+            
+            self.assertEqual([event for event, data in events], ['activity'] * 3 + ['done'])
+            self.assertEqual(sorted(data['category'] for event, data in events[:3]), ['Food', 'Food', 'Tours'])
+            self.assertEqual(events[-1][1]['redirect_url'], f"/itinerary/{self.i1_id}")
+            self.assertEqual(events[-1][1]['skipped'], [])
+            self.assertEqual(events[-1][1]['failed'], {})
+            self.assertEqual(events[-1][1]['empty'], [])
+            
+            saved_ids = {a.id for a in Activity.query.filter_by(itinerary_id=self.i1_id)}
+            self.assertEqual({data['id'] for event, data in events[:3]}, saved_ids)
+            
+            # the stream only reads the job
+            searches = mock_get.call_count
+            replay = client.get(f"/jobs/{job_id}/events").get_data(as_text=True)
+            self.assertEqual(replay.count("event: activity"), 3)
+            self.assertEqual(Activity.query.filter_by(itinerary_id=self.i1_id).count(), 3)
+            self.assertEqual(mock_get.call_count, searches)
+            
+    def test_stream_job_events_other_user(self):
+        """Tests that a user cannot follow another user's job"""
+        user2 = User.register(
+            email="user2@test.com",
+            username="user2",
+            password="testpw2",
+            image_url=None
+        )
+        db.session.commit()
+        job = job_queue.submit(lambda job: None, self.user1_id, 1)
+        
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2.id
+            
+            response = client.get(f"/jobs/{job.id}/events")
+            self.assertEqual(response.status_code, 404)
+            
+    def test_stream_route_removed(self):
+        """Tests that activities can no longer be added with a GET request"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            response = client.get(f'/itinerary/{self.i1_id}/stream?category=Food')
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(Activity.query.count(), 0)
+            
+    def test_job_status_other_user(self):
+        """Tests that a user cannot see another user's job"""
+        user2 = User.register(email="user2@test.com", username="user2", password="testpw2", image_url=None)
+        db.session.commit()
+        job = job_queue.submit(lambda job: None, user2.id, 1)
+        
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            response = client.get(f"/jobs/{job.id}")
+            self.assertEqual(response.status_code, 404)
+        
     def test_add_activity_no_category(self):
         """Tests add_activitty with no category given"""
         with self.client as client:
@@ -225,20 +809,14 @@ class ActivityViewTestCase(TestCase):
         # add activities to i1 and i2
         a1 = Activity(
             user_id = self.user1_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
     
         a2 = Activity(
             user_id = self.user1_id,
-            title = "Some activity",
             category = "outdoor",
-            activity_url = "test.com",
-            address = "345 imaginary st",
-            summary = "summary2"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary2")
         )
         
         self.i1.add_activities([a1])
@@ -278,11 +856,8 @@ class ActivityViewTestCase(TestCase):
         
         a1 = Activity(
             user_id = self.user1_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
         itinerary.add_activities([a1])
         db.session.commit() 
@@ -308,16 +883,183 @@ class ActivityViewTestCase(TestCase):
             self.assertEqual(len(i1_activities), 0)
             
             
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_reroll_activity(self, mock_get):
+        """Tests that an activity is replaced by another cached place of its category that is not in the itinerary"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        process_activities(self.i1, ['Food', 'Food'])
+        search_calls = [c for c in mock_get.call_args_list if 'details' not in c.args[0]]
+        before = {a.id: a.place_id for a in Activity.query.filter_by(itinerary_id=self.i1_id)}
+        activity_id = min(before)
+        
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            resp = c.post(f"/activity/{activity_id}/reroll", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Activity replaced.", resp.get_data(as_text=True))
+            
+            # the only place of the three that was not in the itinerary is picked, without searching again
+            after = {a.id: a.place_id for a in Activity.query.filter_by(itinerary_id=self.i1_id)}
+            unused = {"Food-id-0", "Food-id-1", "Food-id-2"} - set(before.values())
+            self.assertEqual(after[activity_id], unused.pop())
+            self.assertEqual(after[max(before)], before[max(before)])
+            self.assertEqual([c for c in mock_get.call_args_list if 'details' not in c.args[0]], search_calls)
+            
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_reroll_activity_no_other_place(self, mock_get):
+        """Tests that an activity is kept when every place of its category is already in the itinerary"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        process_activities(self.i1, ['Food', 'Food', 'Food'])
+        activity = Activity.query.filter_by(itinerary_id=self.i1_id).first()
+        activity_id, place_id = activity.id, activity.place_id
+        
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            resp = c.post(f"/activity/{activity_id}/reroll", follow_redirects=True)
+            self.assertIn("There are no other Food activities nearby.", resp.get_data(as_text=True))
+            self.assertEqual(Activity.query.get(activity_id).place_id, place_id)
+            
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_avoid_seen_places(self, mock_get):
+        """Tests that new activities avoid the places of the user's other activities until there are no others"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        i2 = Itinerary(title="second itinerary", location="600 E Grand Ave, Chicago, IL", latitude=41.892654, longitude=-87.610168,
+                       user_id=self.user1_id, radius=20)
+        db.session.add(i2)
+        db.session.commit()
+        process_activities(self.i1, ['Food', 'Food'])
+        first = {a.place_id for a in Activity.query.filter_by(itinerary_id=self.i1_id)}
+        
+        # the one place that is not in the first itinerary is picked, then one of the seen places fills the second pick
+        process_activities(i2, ['Food', 'Food'])
+        second = {a.place_id for a in Activity.query.filter_by(itinerary_id=i2.id)}
+        self.assertEqual(len(second), 2)
+        self.assertIn(({"Food-id-0", "Food-id-1", "Food-id-2"} - first).pop(), second)
+        self.assertEqual(seen_places.get(self.user1_id), {"Food-id-0", "Food-id-1", "Food-id-2"})
+        
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_seeded_picks_reproducible(self, mock_get):
+        """Tests that a seeded selection picks the same places for categories that are searched concurrently"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        categories = ['Food', 'Tours', 'Music', 'Hiking']
+
+        picks = []
+        with patch('app.selection', WeightedSelection(seed=7)):
+            for i in range(3):
+                nearby_cache.clear()
+                result = process_activities(self.i1, categories)
+                picks.append([Activity.query.get(activity_id).place_id for activity_id in result['activity_ids']])
+                # the activities are deleted so that the next run does not avoid their places
+                Activity.query.filter_by(itinerary_id=self.i1_id).delete()
+                db.session.commit()
+                seen_places.clear()
+
+        self.assertEqual(picks[0], picks[1])
+        self.assertEqual(picks[0], picks[2])
+
+    @patch.object(maps_client.session, 'get', side_effect=mock_google_get)
+    def test_seen_places_follow_deletes(self, mock_get):
+        """Tests that a deleted activity's place is no longer seen"""
+        self.i1.latitude, self.i1.longitude = 41.892654, -87.610168
+        db.session.commit()
+        process_activities(self.i1, ['Food'])
+        activity = Activity.query.filter_by(itinerary_id=self.i1_id).one()
+        activity_id, place_id = activity.id, activity.place_id
+        self.assertEqual(seen_places.get(self.user1_id), {place_id})
+        
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            c.post(f"/activity/{activity_id}/delete", follow_redirects=True)
+            self.assertEqual(seen_places.get(self.user1_id), set())
+
+    def test_seen_places_wait_for_commit(self):
+        """Tests that seen places only change once the activities are committed, and not after a rollback"""
+        self.assertEqual(seen_places.get(self.user1_id), set())
+        db.session.add(Activity(itinerary_id=self.i1_id, user_id=self.user1_id, category="Food", place=Place(place_id="rolled-back", name="Rolled Back")))
+        db.session.flush()
+        self.assertEqual(seen_places.get(self.user1_id), set())
+        db.session.rollback()
+        self.assertEqual(seen_places.get(self.user1_id), set())
+
+        # a savepoint that rolls back drops its own changes, but not the ones made before it
+        db.session.add(Activity(itinerary_id=self.i1_id, user_id=self.user1_id, category="Food", place=Place(place_id="kept", name="Kept")))
+        db.session.flush()
+        savepoint = db.session.begin_nested()
+        db.session.add(Activity(itinerary_id=self.i1_id, user_id=self.user1_id, category="Food", place=Place(place_id="savepoint", name="Savepoint")))
+        db.session.flush()
+        savepoint.rollback()
+        db.session.commit()
+        self.assertEqual(seen_places.get(self.user1_id), {"kept"})
+
+    def test_seen_place_shared_by_activities(self):
+        """Tests that a place stays seen while the user has another activity there"""
+        place = Place(place_id="shared", name="Shared")
+        a1 = Activity(itinerary_id=self.i1_id, user_id=self.user1_id, category="Food", place=place)
+        a2 = Activity(itinerary_id=self.i1_id, user_id=self.user1_id, category="Food", place=place)
+        db.session.add_all([a1, a2])
+        db.session.commit()
+        self.assertEqual(seen_places.get(self.user1_id), {"shared"})
+
+        db.session.delete(a1)
+        db.session.commit()
+        self.assertEqual(seen_places.get(self.user1_id), {"shared"})
+        db.session.delete(a2)
+        db.session.commit()
+        self.assertEqual(seen_places.get(self.user1_id), set())
+
+    def test_save_activity_place_saved_concurrently(self):
+        """Tests that an activity is saved when its place is stored by another request after it was looked up"""
+        db.session.add(Place(place_id="raced", name="Raced Place", vicinity="1 Race st"))
+        db.session.commit()
+        get = db.session.get
+        lookups = []
+
+        def get_after_race(model, ident, **kwargs):
+            # the first lookup happens before the other request saved the place
+            lookups.append(ident)
+            return None if len(lookups) == 1 else get(model, ident, **kwargs)
+
+        with patch.object(db.session, 'get', side_effect=get_after_race):
+            activity = save_activity(self.i1, {'place_id': "raced", 'title': "Raced Place", 'address': "1 Race st", 'category': "Food"})
+        db.session.commit()
+
+        self.assertEqual(lookups, ["raced", "raced"])
+        self.assertEqual(Activity.query.get(activity.id).title, "Raced Place")
+        self.assertEqual(Place.query.count(), 1)
+
+    def test_reroll_activity_other_user(self):
+        """Tests that another user's activity cannot be rerolled"""
+        user2 = User.register(email="user2@test.com", username="user2", password="testpw2", image_url=None)
+        db.session.commit()
+        activity = Activity(itinerary_id=self.i1_id, user_id=self.user1_id, category="Food", place=Place(place_id="some-restaurant", name="Some Restaurant"))
+        db.session.add(activity)
+        db.session.commit()
+        activity_id = activity.id
+        
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user2.id
+            
+            resp = c.post(f"/activity/{activity_id}/reroll", follow_redirects=True)
+            self.assertIn("Access unauthorized.", resp.get_data(as_text=True))
+            self.assertEqual(Activity.query.get(activity_id).title, "Some Restaurant")
+            
     def test_delete_itinerary_no_user(self):
         """Tests that the activity cannot be deleted when no user is logged in"""
         
         a1 = Activity(
             user_id = self.user1_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
         a1.id=375634
         self.i1.add_activities([a1])
@@ -0,0 +1,233 @@
+"""Cache tests."""
+
+#    python3 -m unittest tests/test_cache.py
+
+from unittest import TestCase
+from unittest.mock import patch
+import threading
+import time
+
+from google_maps import Deadline, DeadlineExceeded
+from cache import TTLCache, SeenPlaces, SingleFlight, geohash, geohash_cells, distance, quantize_radius, within_radius, nearby_search_key
+
+
+class TTLCacheTestCase(TestCase):
+    """Tests the TTLCache."""
+
+    def test_get_set(self):
+        """Tests that stored values are returned and counted as hits"""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1, 'maxsize': 2})
+
+    def test_lru_eviction(self):
+        """Tests that the least recently used entry is evicted when the cache is full"""
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        # reading "a" makes "b" the least recently used
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+    @patch('cache.time.monotonic')
+    def test_expiry(self, mock_time):
+        """Tests that entries expire after their time to live"""
+        mock_time.return_value = 100
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=10)
+
+        mock_time.return_value = 120
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+
+        mock_time.return_value = 161
+        self.assertIsNone(cache.get("a"))
+        # expired values can still be read on purpose
+        self.assertEqual(cache.get_stale("a"), 1)
+        self.assertIsNone(cache.get_stale("c"))
+
+
+class NearbySearchKeyTestCase(TestCase):
+    """Tests the helpers that build nearby search cache keys."""
+
+    def test_geohash(self):
+        """Tests geohash against a known encoding"""
+        self.assertEqual(geohash(57.64911, 10.40744, 11), "u4pruydqqvj")
+        self.assertEqual(geohash(57.64911, 10.40744, 5), "u4pru")
+
+    def test_quantize_radius(self):
+        """Tests that radii are rounded up to a bucket, so that the search covers the whole radius"""
+        self.assertEqual(quantize_radius(1000), 1000)
+        self.assertEqual(quantize_radius(7000), 10000)
+        # Google rejects nearby searches with a radius over 50000 meters
+        self.assertEqual(quantize_radius(50000), 50000)
+        self.assertEqual(quantize_radius(100000), 50000)
+        self.assertEqual(quantize_radius(20), 1000)
+
+    def test_within_radius(self):
+        """Tests that only the places within the radius are kept"""
+        places = [{'place_id': place_id, 'geometry': {'location': {'lat': lat, 'lng': -87.0}}} for place_id, lat in (("near", 41.001), ("far", 41.1))]
+        self.assertEqual([place['place_id'] for place in within_radius(places, (41.0, -87.0), 5000)], ["near"])
+
+    def test_nearby_search_key(self):
+        """Tests that nearby locations, radii and keywords share a key"""
+        key1 = nearby_search_key((41.892654, -87.610168), 12000, "Food")
+        key2 = nearby_search_key((41.892700, -87.610100), 15000, " food")
+        key3 = nearby_search_key((41.892654, -87.610168), 12000, "Food", precision=9)
+
+        self.assertEqual(key1, key2)
+        self.assertEqual(key1, ("dp3wq6", 20000, "food"))
+        self.assertNotEqual(key1, key3)
+
+    def test_geohash_cells(self):
+        """Tests that the cells cover every point within the radius and stay within max_cells"""
+        center = (41.892654, -87.610168)
+        for radius in (20, 1000, 10000, 100000):
+            cells = geohash_cells(*center, radius)
+            self.assertLessEqual(len(cells), 16)
+            for lat_step, lng_step in ((1, 0), (-1, 0), (0, 1), (0, -1), (0.7, 0.7), (-0.7, -0.7)):
+                point = (center[0] + lat_step * radius / 111320, center[1] + lng_step * radius / 82900)
+                self.assertLessEqual(distance(center, point), radius * 1.01)
+                self.assertTrue(any(geohash(*point, 9).startswith(cell) for cell in cells))
+
+    def test_distance(self):
+        """Tests the distance of one degree of latitude"""
+        self.assertAlmostEqual(distance((41.0, -87.0), (42.0, -87.0)), 111195, delta=1)
+
+
+class SeenPlacesTestCase(TestCase):
+    """Tests the SeenPlaces store."""
+
+    def test_loaded_once_and_updated(self):
+        """Tests that a user's places are loaded once and then follow add and discard"""
+        loads = []
+        seen = SeenPlaces(lambda user_id: loads.append(user_id) or ["a", "b"])
+
+        self.assertEqual(seen.get(1), {"a", "b"})
+        seen.add(1, "c")
+        seen.discard(1, "a")
+        self.assertEqual(seen.get(1), {"b", "c"})
+        self.assertEqual(loads, [1])
+
+    def test_add_before_load(self):
+        """Tests that places added for a user who was not loaded yet are left to the load"""
+        seen = SeenPlaces(lambda user_id: ["a"])
+        seen.add(1, "b")
+        self.assertEqual(seen.get(1), {"a"})
+
+    def test_place_shared_by_activities(self):
+        """Tests that a place stays seen until every activity of the user at it is discarded"""
+        seen = SeenPlaces(lambda user_id: ["a", "a"])
+        seen.get(1)
+        seen.add(1, "b")
+        seen.add(1, "b")
+
+        seen.discard(1, "a")
+        seen.discard(1, "b")
+        self.assertEqual(seen.get(1), {"a", "b"})
+        seen.discard(1, "a")
+        self.assertEqual(seen.get(1), {"b"})
+
+
+class SingleFlightTestCase(TestCase):
+    """Tests the SingleFlight request coalescer."""
+
+    def test_concurrent_calls_collapsed(self):
+        """Tests that concurrent calls with the same key share one call and its result"""
+        single_flight = SingleFlight()
+        started = threading.Event()
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            started.set()
+            time.sleep(0.1)
+            return "result"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do("key", slow_call))) for i in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["result"] * 5)
+        self.assertEqual(single_flight.stats(), {'calls': 1, 'collapsed': 4})
+
+    def test_sequential_calls_not_collapsed(self):
+        """Tests that a key is called again once the previous call has finished"""
+        single_flight = SingleFlight()
+        self.assertEqual(single_flight.do("key", lambda: 1), 1)
+        self.assertEqual(single_flight.do("key", lambda: 2), 2)
+        self.assertEqual(single_flight.stats(), {'calls': 2, 'collapsed': 0})
+
+    def test_exception_shared(self):
+        """Tests that an exception raised by the call is raised to the caller"""
+        single_flight = SingleFlight()
+
+        def failing_call():
+            raise ValueError("failed")
+
+        with self.assertRaises(ValueError):
+            single_flight.do("key", failing_call)
+        self.assertEqual(single_flight.do("key", lambda: "ok"), "ok")
+
+    def test_follower_deadline(self):
+        """Tests that a caller waiting for a slow call gives up at its own deadline"""
+        single_flight = SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def slow_call():
+            started.set()
+            release.wait()
+            return "result"
+
+        leader = threading.Thread(target=single_flight.do, args=("key", slow_call))
+        leader.start()
+        started.wait()
+        with self.assertRaises(DeadlineExceeded):
+            single_flight.do("key", slow_call, deadline=Deadline(0.05))
+        release.set()
+        leader.join()
+
+    def test_leader_deadline_not_shared(self):
+        """Tests that a caller with time left calls again when the call it waited for ran out of time"""
+        single_flight = SingleFlight()
+        started = threading.Event()
+        calls = []
+
+        def call(deadline):
+            calls.append(deadline)
+            if len(calls) == 1:
+                started.set()
+                time.sleep(0.1)
+                deadline.check()
+            return "result"
+
+        errors = []
+        def lead():
+            try:
+                single_flight.do("key", call, deadline=Deadline(0.05))
+            except DeadlineExceeded as e:
+                errors.append(e)
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait()
+        follower_deadline = Deadline(5)
+        self.assertEqual(single_flight.do("key", call, deadline=follower_deadline), "result")
+        leader.join()
+
+        self.assertEqual(len(errors), 1)
+        self.assertIs(calls[1], follower_deadline)
@@ -0,0 +1,322 @@
+"""Google Maps client tests."""
+
+#    python3 -m unittest tests/test_google_maps.py
+
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+import threading
+import requests
+
+from google_maps import GoogleMapsClient, RateLimiter, RateLimitExceeded, CircuitBreaker, CircuitOpen, Deadline, DeadlineExceeded, Hedger, GOOGLE_MAPS_URLS, RequestRefused, check_status
+
+
+def make_response(status_code, content=b'{"status": "OK"}'):
+    """Returns a fake response with the status code"""
+    resp = MagicMock()
+    resp.status_code = status_code
+    resp.content = content
+    return resp
+
+
+@patch('google_maps.time.sleep')
+class GoogleMapsClientTestCase(TestCase):
+    """Tests the GoogleMapsClient."""
+
+    def setUp(self):
+        self.client = GoogleMapsClient("test-key", timeouts={'details': (1, 2)}, retries=2)
+
+    def test_get(self, mock_sleep):
+        """Tests that the api key and endpoint timeout are added to the request"""
+        with patch.object(self.client.session, 'get', return_value=make_response(200)) as mock_get:
+            resp = self.client.get('details', {'place_id': "abc"})
+
+        self.assertEqual(resp.status_code, 200)
+        mock_get.assert_called_once_with(
+            GOOGLE_MAPS_URLS['details'],
+            params={'place_id': "abc", 'key': "test-key"},
+            timeout=(1, 2)
+        )
+        mock_sleep.assert_not_called()
+
+    def test_retry_server_error(self, mock_sleep):
+        """Tests that 5xx responses are retried until one succeeds"""
+        responses = [make_response(503), make_response(200)]
+        with patch.object(self.client.session, 'get', side_effect=responses) as mock_get:
+            resp = self.client.get('geocode', {'address': "Chicago"})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(self.client.stats()['endpoints']['geocode']['retries'], 1)
+
+    def test_retry_connection_error(self, mock_sleep):
+        """Tests that connection errors are retried and raised once the retries run out"""
+        with patch.object(self.client.session, 'get', side_effect=requests.ConnectionError()) as mock_get:
+            with self.assertRaises(requests.ConnectionError):
+                self.client.get('nearbysearch', {'keyword': "Food"})
+
+        self.assertEqual(mock_get.call_count, 3)
+        stats = self.client.stats()['endpoints']['nearbysearch']
+        self.assertEqual(stats['errors'], 3)
+        self.assertEqual(stats['requests'], 0)
+
+    def test_retry_throttled(self, mock_sleep):
+        """Tests that throttled requests are retried and lower the concurrency limit"""
+        responses = [make_response(200, b'{"status": "OVER_QUERY_LIMIT"}'), make_response(200)]
+        with patch.object(self.client.session, 'get', side_effect=responses) as mock_get:
+            resp = self.client.get('geocode', {'address': "Chicago"})
+
+        self.assertEqual(resp.content, b'{"status": "OK"}')
+        self.assertEqual(mock_get.call_count, 2)
+        limiter_stats = self.client.stats()['endpoints']['geocode']['rate_limiter']
+        self.assertEqual(limiter_stats['throttled'], 1)
+        self.assertEqual(limiter_stats['concurrency_limit'], 5)
+
+    def test_other_request_error_recorded(self, mock_sleep):
+        """Tests that request errors that are not retried are still recorded, so a half-open circuit is not stuck"""
+        self.client.breakers['details'] = CircuitBreaker(min_requests=1, reset_timeout=0)
+        with patch.object(self.client.session, 'get', side_effect=requests.TooManyRedirects()) as mock_get:
+            with self.assertRaises(requests.TooManyRedirects):
+                self.client.get('details', {'place_id': "abc"})
+            # the circuit opened and, once half-open, its trial fails the same way and is recorded again
+            with self.assertRaises(requests.TooManyRedirects):
+                self.client.get('details', {'place_id': "abc"})
+
+        self.assertEqual(mock_get.call_count, 2)
+        self.assertEqual(self.client.stats()['endpoints']['details']['errors'], 2)
+        # the trial was recorded, so another one is let through
+        self.assertTrue(self.client.breakers['details'].allow())
+
+    def test_circuit_open(self, mock_sleep):
+        """Tests that requests are not sent while the circuit is open"""
+        self.client.breakers['details'] = CircuitBreaker(min_requests=1, reset_timeout=60)
+        with patch.object(self.client.session, 'get', return_value=make_response(503)) as mock_get:
+            with self.assertRaises(CircuitOpen):
+                self.client.get('details', {'place_id': "abc"})
+
+        # the first failure opened the circuit, so the retries were not sent
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(self.client.circuit_state('details'), 'open')
+
+    def test_client_error_not_retried(self, mock_sleep):
+        """Tests that 4xx responses are returned without retrying"""
+        with patch.object(self.client.session, 'get', return_value=make_response(400)) as mock_get:
+            resp = self.client.get('geocode', {'address': "Chicago"})
+
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(self.client.stats()['endpoints']['geocode']['requests'], 1)
+
+    def test_deadline_shortens_timeout(self, mock_sleep):
+        """Tests that the timeouts are shortened to the time left before the deadline"""
+        with patch.object(self.client.session, 'get', return_value=make_response(200)) as mock_get:
+            self.client.get('details', {'place_id': "abc"}, deadline=Deadline(0.5))
+
+        connect_timeout, read_timeout = mock_get.call_args.kwargs['timeout']
+        self.assertLessEqual(connect_timeout, 0.5)
+        self.assertLessEqual(read_timeout, 0.5)
+
+    def test_deadline_exceeded(self, mock_sleep):
+        """Tests that nothing is sent once the deadline has passed"""
+        with patch.object(self.client.session, 'get') as mock_get:
+            with self.assertRaises(DeadlineExceeded):
+                self.client.get('details', {'place_id': "abc"}, deadline=Deadline(0))
+
+        mock_get.assert_not_called()
+
+
+class CheckStatusTestCase(TestCase):
+    """Tests check_status."""
+
+    def test_results(self):
+        """Tests that OK and ZERO_RESULTS responses are returned"""
+        for status in ('OK', 'ZERO_RESULTS'):
+            resp = make_response(200)
+            resp.json.return_value = {'status': status, 'results': []}
+            self.assertEqual(check_status('nearbysearch', resp)['status'], status)
+
+    def test_refused(self):
+        """Tests that throttled, denied and failed requests raise RequestRefused"""
+        for status in ('OVER_QUERY_LIMIT', 'REQUEST_DENIED', 'UNKNOWN_ERROR'):
+            resp = make_response(200)
+            resp.json.return_value = {'status': status}
+            with self.assertRaises(RequestRefused):
+                check_status('nearbysearch', resp)
+        with self.assertRaises(RequestRefused):
+            check_status('geocode', make_response(503))
+
+    def test_other_errors(self):
+        """Tests that any other status raises an error that is not mistaken for Google being unavailable"""
+        resp = make_response(200)
+        resp.json.return_value = {'status': 'INVALID_REQUEST'}
+        with self.assertRaises(Exception) as context:
+            check_status('nearbysearch', resp)
+        self.assertNotIsInstance(context.exception, RequestRefused)
+        self.assertEqual(str(context.exception), "Google Maps nearbysearch error: INVALID_REQUEST")
+
+
+class RateLimiterTestCase(TestCase):
+    """Tests the RateLimiter."""
+
+    def test_burst(self):
+        """Tests that requests up to the burst do not wait"""
+        limiter = RateLimiter(rate=1, burst=3, max_wait=0)
+        for i in range(3):
+            limiter.acquire()
+            limiter.release()
+
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()['rejected'], 1)
+        self.assertEqual(limiter.stats()['waits'], 0)
+
+    def test_wait_for_token(self):
+        """Tests that callers wait for the next token instead of failing"""
+        limiter = RateLimiter(rate=100, burst=1, max_wait=1)
+        limiter.acquire()
+        limiter.release()
+        limiter.acquire()
+        limiter.release()
+
+        stats = limiter.stats()
+        self.assertEqual(stats['rejected'], 0)
+        self.assertEqual(stats['waits'], 1)
+        self.assertGreater(stats['max_wait_ms'], 1)
+
+    def test_concurrency_limit(self):
+        """Tests that throttling halves the concurrency limit and successes raise it again"""
+        limiter = RateLimiter(rate=1000, burst=1000, max_concurrency=4, max_wait=0)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        limiter.acquire()
+        limiter.release(throttled=True)
+        self.assertEqual(limiter.stats()['concurrency_limit'], 1)
+
+        # only one request can be in flight
+        limiter.acquire()
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire()
+        limiter.release()
+        self.assertEqual(limiter.stats()['concurrency_limit'], 2)
+
+
+@patch('google_maps.time.monotonic')
+class CircuitBreakerTestCase(TestCase):
+    """Tests the CircuitBreaker."""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(window=4, min_requests=4, failure_rate=0.5, slow_ms=1000, reset_timeout=30)
+
+    def test_opens_on_failures(self, mock_time):
+        """Tests that the circuit opens once the failure rate is reached"""
+        mock_time.return_value = 0
+        self.breaker.record(True, 10)
+        self.breaker.record(True, 10)
+        self.breaker.record(False, 10)
+        self.assertEqual(self.breaker.state, 'closed')
+
+        # slow responses count as failures
+        self.breaker.record(True, 5000)
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats(), {'state': 'open', 'opened': 1})
+
+    def test_half_open(self, mock_time):
+        """Tests that one trial request is let through after the reset timeout"""
+        mock_time.return_value = 0
+        for i in range(4):
+            self.breaker.record(False, 10)
+
+        mock_time.return_value = 31
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        # a failed trial opens the circuit again
+        self.breaker.record(False, 10)
+        self.assertEqual(self.breaker.state, 'open')
+
+        # a successful trial closes it
+        mock_time.return_value = 62
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(True, 10)
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_ignores_requests_sent_before_opening(self, mock_time):
+        """Tests that a request that was in flight when the circuit opened does not decide the trial"""
+        mock_time.return_value = 5
+        for i in range(4):
+            self.breaker.record(False, 10, sent_at=4)
+
+        mock_time.return_value = 36
+        self.assertTrue(self.breaker.allow())
+        # a request sent before the circuit opened finishes first and is ignored, so the trial is still in flight
+        self.breaker.record(True, 10, sent_at=0)
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record(True, 10, sent_at=36)
+        self.assertEqual(self.breaker.state, 'closed')
+
+
+class HedgerTestCase(TestCase):
+    """Tests hedged requests."""
+
+    def test_delay(self):
+        """Tests that the hedging delay is the percentile of the recorded latencies once there are enough of them"""
+        hedger = Hedger(percentile=90, min_samples=10)
+        for elapsed_ms in range(1, 10):
+            hedger.record(elapsed_ms * 100)
+        self.assertIsNone(hedger.delay())
+
+        hedger.record(1000)
+        self.assertEqual(hedger.delay(), 0.9)
+
+    def test_budget(self):
+        """Tests that the hedges stay under max_ratio of the requests"""
+        hedger = Hedger(max_ratio=0.1)
+        for i in range(20):
+            hedger.start()
+        self.assertTrue(hedger.allow())
+        self.assertTrue(hedger.allow())
+        self.assertFalse(hedger.allow())
+        self.assertEqual(hedger.stats()['fired'], 2)
+
+    def test_hedge_wins(self):
+        """Tests that a slow request is sent again and the first response is returned"""
+        client = GoogleMapsClient("test-key", hedging={'nearbysearch': {'max_ratio': 1, 'min_samples': 2}})
+        client.hedgers['nearbysearch'].record(10)
+        client.hedgers['nearbysearch'].record(10)
+
+        # the first request hangs until the test ends, the copy answers right away
+        release = threading.Event()
+        slow, fast = make_response(200, b'{"status": "SLOW"}'), make_response(200, b'{"status": "FAST"}')
+        def session_get(url, params=None, timeout=None):
+            if session_get.calls == 0:
+                session_get.calls += 1
+                release.wait(5)
+                return slow
+            return fast
+        session_get.calls = 0
+
+        with patch.object(client.session, 'get', side_effect=session_get) as mock_get:
+            resp = client.get('nearbysearch', {'keyword': "Food"})
+            release.set()
+
+        self.assertIs(resp, fast)
+        self.assertEqual(mock_get.call_count, 2)
+        hedging = client.stats()['endpoints']['nearbysearch']['hedging']
+        self.assertEqual((hedging['fired'], hedging['won']), (1, 1))
+
+    def test_no_hedge_when_fast(self):
+        """Tests that a request that answers within the hedging delay is not sent again"""
+        client = GoogleMapsClient("test-key", hedging={'nearbysearch': {'max_ratio': 1, 'min_samples': 2}})
+        client.hedgers['nearbysearch'].record(1000)
+        client.hedgers['nearbysearch'].record(1000)
+
+        with patch.object(client.session, 'get', return_value=make_response(200)) as mock_get:
+            client.get('nearbysearch', {'keyword': "Food"})
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(client.hedgers['nearbysearch'].stats()['fired'], 0)
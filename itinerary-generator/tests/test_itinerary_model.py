@@ -5,7 +5,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Activity, Itinerary
+from models import db, User, Activity, Itinerary, Place
 
 os.environ['DATABASE_URL'] = "postgresql:///spontinerary-test"
 
@@ -88,20 +88,14 @@ class ItineraryModelTestCase(TestCase):
         # create activities 
         a1 = Activity(
             user_id = self.user1_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
         
         a2 = Activity(
             user_id = self.user1_id,
-            title = "Some activity",
             category = "outdoor",
-            activity_url = "test.com",
-            address = "345 imaginary st",
-            summary = "summary2"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary2")
         )
         
         itinerary.add_activities([a1,a2])
@@ -5,8 +5,10 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import event
 
-from models import db, connect_db, User, Activity, Itinerary
+from models import db, connect_db, User, Activity, Itinerary, Place
 
 os.environ['DATABASE_URL'] = "postgresql:///spontinerary-test"
 
@@ -65,6 +67,38 @@ class ItineraryViewTestCase(TestCase):
         db.session.rollback()
         return res
     
+    def count_dashboard_queries(self):
+        """Returns the response of the user's dashboard and the number of queries made to render it"""
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            with self.client as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.user1_id
+                response = client.get('/')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        return response, len(statements)
+
+    def test_dashboard_activity_counts(self):
+        """Tests that the dashboard shows the activity count of each itinerary with the same number of queries for any number of itineraries"""
+        response, queries = self.count_dashboard_queries()
+        self.assertIn("Activity Count: 0,", response.get_data(as_text=True))
+        
+        for i in range(5):
+            itinerary = Itinerary(title=f"itinerary {i}", location="some place", user_id=self.user1_id, radius=20)
+            itinerary.add_activities([
+                Activity(user_id=self.user1_id, category="eats", place=Place(place_id=f"place-{i}-{j}", name=f"place {j}"))
+                for j in range(i)
+            ])
+            db.session.add(itinerary)
+        db.session.commit()
+        
+        response, more_queries = self.count_dashboard_queries()
+        self.assertIn("Activity Count: 4,", response.get_data(as_text=True))
+        self.assertEqual(more_queries, queries)
+        
     def test_create_itinerary(self):
         """Tests creating a new itinerary with valid data"""
         with self.client as client:
@@ -75,6 +109,8 @@ class ItineraryViewTestCase(TestCase):
             response = self.client.post('/itinerary/new', data={
                 'title': 'Test Itinerary',
                 'location': 'Test Location',
+                'latitude': '41.892654',
+                'longitude': '-87.610168',
                 'radius': '10',
                 'notes': 'Test note'
             }, follow_redirects=True)
@@ -91,6 +127,28 @@ class ItineraryViewTestCase(TestCase):
             self.assertEqual(itinerary.radius, 10000)  
             self.assertEqual(itinerary.notes, 'Test note')
             self.assertEqual(itinerary.user_id, self.user1_id)
+            self.assertEqual(itinerary.latitude, 41.892654)
+            self.assertEqual(itinerary.longitude, -87.610168)
+            
+    @patch('app.get_long_lat', return_value=(40.7128, -74.006))
+    def test_create_itinerary_geocode_fallback(self, mock_geocode):
+        """Tests that the location is geocoded by the server when the coordinates are missing"""
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1_id
+            
+            response = self.client.post('/itinerary/new', data={
+                'title': 'NYC Itinerary',
+                'location': 'New York, NY',
+                'radius': '10'
+            }, follow_redirects=True)
+
+            self.assertEqual(response.status_code, 200)
+            mock_geocode.assert_called_once_with('New York, NY')
+            
+            itinerary = Itinerary.query.filter_by(title='NYC Itinerary').first()
+            self.assertEqual(itinerary.latitude, 40.7128)
+            self.assertEqual(itinerary.longitude, -74.006)
         
     def test_create_itinerary_missing_title(self):
         """Test that creating an itinerary fails if the user doesnt add a title."""
@@ -128,20 +186,14 @@ class ItineraryViewTestCase(TestCase):
         # add activities to i1
         a1 = Activity(
             user_id = self.user1_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
     
         a2 = Activity(
             user_id = self.user1_id,
-            title = "Some activity",
             category = "outdoor",
-            activity_url = "test.com",
-            address = "345 imaginary st",
-            summary = "summary2"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st", summary="summary2")
         )
         
         self.i1.add_activities([a1,a2])
@@ -183,11 +235,8 @@ class ItineraryViewTestCase(TestCase):
         
         a1 = Activity(
             user_id = self.user1_id,
-            title = "Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st",
-            summary = "summary1"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st", summary="summary1")
         )
         itinerary.add_activities([a1])
         
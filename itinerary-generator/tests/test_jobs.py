@@ -0,0 +1,88 @@
+"""Job queue tests."""
+
+#    python3 -m unittest tests/test_jobs.py
+
+import os
+import time
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, User, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///spontinerary-test"
+
+from app import app
+from jobs import ThreadJobQueue, JOB_FAILED_MESSAGE
+app.app_context().push()
+
+
+def wait_for(job, timeout=5):
+    """Waits until the job has finished, reloading it from the database"""
+    deadline = time.monotonic() + timeout
+    while job.status in ('queued', 'running') and time.monotonic() < deadline:
+        time.sleep(0.01)
+        db.session.refresh(job)
+
+
+class ThreadJobQueueTestCase(TestCase):
+    """Tests the ThreadJobQueue."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        user = User.register(email="user1@test.com", username="user1", password="testpw1", image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+        self.queue = ThreadJobQueue(app, max_workers=2, ttl=60)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_submit(self):
+        """Tests that a job runs in the background and stores its result and progress"""
+        def work(job, value):
+            job.advance()
+            job.advance()
+            return {'value': value}
+
+        job = self.queue.submit(work, self.user_id, 2, "hello")
+        wait_for(job)
+
+        self.assertEqual(self.queue.get(job.id).id, job.id)
+        self.assertEqual(job.to_dict(), {
+            'job_id': job.id,
+            'status': 'done',
+            'completed': 2,
+            'total': 2,
+            'result': {'value': "hello"},
+            'error': None,
+        })
+
+    def test_failed_job(self):
+        """Tests that a failed job stores a message that does not show the error, which is only logged"""
+        def work(job):
+            raise Exception("(psycopg2.errors.UniqueViolation) INSERT INTO activities ...")
+
+        with self.assertLogs(app.logger, 'ERROR'):
+            job = self.queue.submit(work, self.user_id, 1)
+            wait_for(job)
+
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.error, JOB_FAILED_MESSAGE)
+
+    def test_job_from_another_process(self):
+        """Tests that a job saved by another queue, as in another worker process, can be read"""
+        job = Job(user_id=self.user_id, total=1, status='done', result={'value': 1})
+        db.session.add(job)
+        db.session.commit()
+
+        self.assertEqual(self.queue.get(job.id).result, {'value': 1})
+
+    def test_missing_and_expired_jobs(self):
+        """Tests that unknown and expired job ids return None"""
+        job = Job(user_id=self.user_id, total=1, timestamp=datetime.utcnow() - timedelta(seconds=120))
+        db.session.add(job)
+        db.session.commit()
+
+        self.assertIsNone(self.queue.get("not-a-job"))
+        self.assertIsNone(self.queue.get(job.id))
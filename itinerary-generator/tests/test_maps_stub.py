@@ -0,0 +1,47 @@
+"""Google Maps stub tests."""
+
+#    python3 -m unittest tests/test_maps_stub.py
+
+from unittest import TestCase
+
+from benchmarks.maps_stub import StubConfig, start_stub
+from google_maps import GoogleMapsClient
+
+
+class MapsStubTestCase(TestCase):
+    """Tests the Google Maps stand-in server through the GoogleMapsClient."""
+
+    def setUp(self):
+        self.stub = start_stub(StubConfig(median_ms=1, sigma=0, result_count=5))
+        self.client = GoogleMapsClient("test-key", base_url=self.stub.url)
+
+    def tearDown(self):
+        self.stub.shutdown()
+        self.stub.server_close()
+
+    def test_endpoints(self):
+        """Tests that the stub answers the geocode, nearby search and details endpoints"""
+        geocode = self.client.get('geocode', {'address': "Chicago"}).json()
+        self.assertEqual(geocode['status'], 'OK')
+
+        places = self.client.get('nearbysearch', {'location': "41.89,-87.61", 'radius': 5000, 'keyword': "Food"}).json()['results']
+        self.assertEqual(len(places), 5)
+        self.assertEqual(places[0]['name'], "Food Place 1")
+
+        # the same search returns the same places
+        again = self.client.get('nearbysearch', {'location': "41.89,-87.61", 'radius': 5000, 'keyword': "Food"}).json()['results']
+        self.assertEqual([place['place_id'] for place in again], [place['place_id'] for place in places])
+
+        details = self.client.get('details', {'place_id': places[0]['place_id']}).json()['result']
+        self.assertIn(places[0]['place_id'], details['url'])
+
+        self.assertEqual(self.stub.config.requests, {'geocode': 1, 'nearbysearch': 2, 'details': 1})
+        # the client reused its keep-alive connection
+        self.assertEqual(self.client.stats()['connections_opened'], 1)
+
+    def test_errors(self):
+        """Tests that the stub fails the configured share of requests"""
+        self.stub.config.error_rate = 1.0
+        self.client.retries = 0
+        resp = self.client.get('geocode', {'address': "Chicago"})
+        self.assertEqual(resp.status_code, 500)
@@ -0,0 +1,99 @@
+"""Activity selection tests."""
+
+#    python3 -m unittest tests/test_sampling.py
+
+import random
+from collections import Counter
+from unittest import TestCase
+
+from sampling import AliasTable, UniformSelection, WeightedSelection, place_weights
+
+
+def make_places(*ratings):
+    """Returns places with the (rating, user_ratings_total) pairs"""
+    return [
+        {'place_id': f"id-{i}", 'name': f"place {i}", 'rating': rating, 'user_ratings_total': total}
+        for i, (rating, total) in enumerate(ratings)
+    ]
+
+
+class AliasTableTestCase(TestCase):
+    """Tests the AliasTable."""
+
+    def test_draw_distribution(self):
+        """Tests that indexes are drawn in proportion to their weights"""
+        table = AliasTable([1, 2, 3, 0])
+        rng = random.Random(1)
+        counts = Counter(table.draw(rng) for i in range(60000))
+
+        self.assertEqual(counts[3], 0)
+        self.assertAlmostEqual(counts[0] / 60000, 1 / 6, delta=0.01)
+        self.assertAlmostEqual(counts[1] / 60000, 2 / 6, delta=0.01)
+        self.assertAlmostEqual(counts[2] / 60000, 3 / 6, delta=0.01)
+
+
+class SelectionTestCase(TestCase):
+    """Tests the selection strategies."""
+
+    def test_place_weights(self):
+        """Tests that well rated, popular places weigh more than places with a few good reviews"""
+        landmark, few_reviews, poor, unrated = place_weights(make_places((4.7, 5000), (5.0, 3), (2.0, 3), (None, None)))
+
+        self.assertGreater(landmark, few_reviews)
+        self.assertGreater(few_reviews, poor)
+        self.assertGreater(unrated, 0)
+
+    def test_weighted_favours_popular(self):
+        """Tests that the weighted selection picks a landmark more often than a 2 star place with 3 reviews"""
+        places = make_places((4.7, 5000), (2.0, 3))
+        selection = WeightedSelection(seed=1)
+        counts = Counter(selection.select(places, 1)[0]['place_id'] for i in range(1000))
+
+        self.assertGreater(counts['id-0'], 3 * counts['id-1'])
+
+    def test_select_distinct_and_excluded(self):
+        """Tests that the picks are different places and leave out the excluded ones"""
+        places = make_places((4.7, 5000), (4.0, 100), (3.0, 10), (2.0, 3))
+        for selection in (WeightedSelection(seed=1), UniformSelection(seed=1)):
+            picks = selection.select(places, 3, exclude={'id-0'})
+            self.assertEqual(sorted(place['place_id'] for place in picks), ['id-1', 'id-2', 'id-3'])
+            self.assertEqual(selection.select(places, 5, exclude={'id-0', 'id-1', 'id-2', 'id-3'}), [])
+
+    def test_seed(self):
+        """Tests that strategies with the same seed make the same picks"""
+        places = make_places(*[(rating / 2, rating * 10) for rating in range(1, 11)])
+        first, second = WeightedSelection(seed=42), WeightedSelection(seed=42)
+
+        self.assertEqual(
+            [first.select(places, 3) for i in range(10)],
+            [second.select(places, 3) for i in range(10)]
+        )
+
+    def test_seeded_generator_per_key(self):
+        """Tests that a seeded strategy gives each key its own generator, so the picks do not depend on the order of the keys"""
+        places = make_places(*[(rating / 2, rating * 10) for rating in range(1, 11)])
+        first, second = WeightedSelection(seed=42), WeightedSelection(seed=42)
+
+        first_picks = {key: first.select(places, 3, rng=first.rng_for(key)) for key in ("food", "tours")}
+        second_picks = {key: second.select(places, 3, rng=second.rng_for(key)) for key in ("tours", "food")}
+        self.assertEqual(first_picks, second_picks)
+        # without a seed the strategy's own generator is used
+        unseeded = UniformSelection()
+        self.assertIs(unseeded.rng_for("food"), unseeded.rng)
+
+    def test_alias_table_reused(self):
+        """Tests that the alias table of a candidate list is built once"""
+        places = make_places((4.7, 5000), (2.0, 3))
+        selection = WeightedSelection(seed=1)
+
+        self.assertIs(selection.alias_table(places), selection.alias_table(list(places)))
+
+    def test_select_fresh(self):
+        """Tests that seen places are only picked once every other place was picked"""
+        places = make_places((4.7, 5000), (4.0, 100), (3.0, 10), (2.0, 3))
+        for selection in (WeightedSelection(seed=1), UniformSelection(seed=1)):
+            picks = selection.select_fresh(places, 2, seen={'id-0', 'id-1'})
+            self.assertEqual(sorted(place['place_id'] for place in picks), ['id-2', 'id-3'])
+            picks = selection.select_fresh(places, 3, seen={'id-0', 'id-1'}, exclude={'id-3'})
+            self.assertEqual(sorted(place['place_id'] for place in picks), ['id-0', 'id-1', 'id-2'])
+            self.assertEqual(picks[0]['place_id'], 'id-2')
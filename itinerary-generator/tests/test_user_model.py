@@ -7,7 +7,7 @@ import os
 from unittest import TestCase
 from sqlalchemy import exc
 
-from models import db, User, Activity, Itinerary, bcrypt
+from models import db, User, Activity, Itinerary, Place, bcrypt
 
 os.environ['DATABASE_URL'] = "postgresql:///spontinerary-test"
 
@@ -90,18 +90,14 @@ class UserModelTestCase(TestCase):
         # Add activities to the itinerary
         a1 = Activity(
             user_id = self.user1_id,
-            title="Some Restaurant",
             category = "eats",
-            activity_url = "test.com",
-            address = "123 imaginary st"
+            place = Place(place_id="some-restaurant", name="Some Restaurant", url="test.com", vicinity="123 imaginary st")
         )
         
         a2 = Activity(
             user_id = self.user1_id,
-            title="Some activity",
             category = "outdoor",
-            activity_url = "test.com",
-            address = "345 imaginary st"
+            place = Place(place_id="some-activity", name="Some activity", url="test.com", vicinity="345 imaginary st")
         )
         
         i1.add_activities([a1,a2])